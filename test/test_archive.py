@@ -0,0 +1,174 @@
+"""
+Test importing from zip and tar archives without unpacking them.
+"""
+
+import tarfile
+import zipfile
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.twimport import (import_one, archive_to_urls,
+        recipe_to_urls, url_to_tiddler, ImportContext)
+
+FILES = [
+        ('alpha/Welcome.tid', 'test/samples/alpha/Welcome.tid'),
+        ('alpha/Greetings.tiddler', 'test/samples/alpha/Greetings.tiddler'),
+        ('alpha/fnord.css', 'test/samples/alpha/fnord.css'),
+        ('alpha/fnord.css.meta', 'test/samples/alpha/fnord.css.meta'),
+        ('alpha/plugins/aplugin.js', 'test/samples/alpha/plugins/aplugin.js'),
+        ('alpha/plugins/aplugin.js.meta',
+            'test/samples/alpha/plugins/aplugin.js.meta'),
+        ('beta/Hello.tid', 'test/samples/beta/Hello.tid'),
+        ('beta/buried/hole.js', 'test/samples/beta/buried/hole.js'),
+        ('beta/buried/short.recipe', 'test/samples/beta/buried/short.recipe'),
+]
+RECIPE = """tiddler: Welcome.tid
+tiddler: plugins/aplugin.js
+tiddler: ../beta/Hello.tid
+recipe: ../beta/buried/short.recipe
+"""
+
+
+def setup_module(module):
+    module.store = Store(config['server_store'][0],
+            config['server_store'][1], {'tiddlyweb.config': config})
+
+
+def _cleanup(name):
+    bag = Bag(name)
+    try:
+        store.delete(bag)
+    except NoBagError:
+        pass
+    store.put(bag)
+    return bag
+
+
+def _make_zip(tmpdir):
+    path = str(tmpdir.join('content.zip'))
+    archive = zipfile.ZipFile(path, 'w')
+    for name, source in FILES:
+        archive.write(source, name)
+    archive.writestr('alpha/index.recipe', RECIPE)
+    archive.close()
+    return path
+
+
+def _make_tar(tmpdir):
+    recipe = tmpdir.join('index.recipe')
+    recipe.write(RECIPE)
+    path = str(tmpdir.join('content.tar.gz'))
+    archive = tarfile.open(path, 'w:gz')
+    for name, source in FILES:
+        archive.add(source, './' + name)
+    archive.add(str(recipe), './alpha/index.recipe')
+    archive.close()
+    return path
+
+
+def test_archive_to_urls(tmpdir):
+    path = _make_zip(tmpdir)
+
+    urls = archive_to_urls(path)
+
+    assert len(urls) == 6
+    assert 'file://%s!/alpha/Welcome.tid' % path in urls
+    assert not [url for url in urls if url.endswith('.meta')]
+    assert not [url for url in urls if url.endswith('.recipe')]
+
+
+def test_archive_member_tiddler(tmpdir):
+    path = _make_tar(tmpdir)
+    context = ImportContext()
+
+    plugin = url_to_tiddler(path + '!/alpha/plugins/aplugin.js',
+            context=context)
+    css = url_to_tiddler(path + '!/alpha/fnord.css', context=context)
+
+    assert plugin.title == 'aplugin'
+    assert 'excludeLists' in plugin.tags
+    assert css.type == 'text/css'
+    assert sorted(css.tags) == ['alpha', 'beta']
+
+
+def test_archive_recipe(tmpdir):
+    path = _make_tar(tmpdir)
+
+    urls = recipe_to_urls(path + '!/alpha/index.recipe')
+
+    assert urls == ['file://%s!/%s' % (path, name) for name in
+            ['alpha/Welcome.tid', 'alpha/plugins/aplugin.js',
+                'beta/Hello.tid', 'beta/buried/hole.js']]
+
+
+def test_import_archive(tmpdir):
+    bag = _cleanup('testarchive')
+    import_one('testarchive', _make_zip(tmpdir), store)
+
+    titles = sorted(tiddler.title
+            for tiddler in store.list_bag_tiddlers(bag))
+    assert titles == ['Greetings', 'Hello', 'Welcome', 'aplugin',
+            'fnord.css', 'hole']
+
+
+def test_import_archive_recipe_fragment(tmpdir):
+    bag = _cleanup('testarchive')
+    import_one('testarchive', _make_tar(tmpdir)
+            + '!/alpha/index.recipe#Hello', store)
+
+    tiddlers = list(store.list_bag_tiddlers(bag))
+    assert [tiddler.title for tiddler in tiddlers] == ['Hello']
+    tiddler = store.get(Tiddler('Hello', 'testarchive'))
+    assert tiddler.modifier == 'cdent'
+
+
+def test_recipe_refers_to_member(tmpdir):
+    bag = _cleanup('testarchive')
+    _make_tar(tmpdir)
+    recipe = tmpdir.join('outside.recipe')
+    recipe.write('tiddler: content.tar.gz!/beta/Hello.tid\n'
+            'tiddler: content.tar.gz!/alpha/fnord.css\n')
+
+    assert recipe_to_urls(str(recipe)) == ['file://%s!/%s' % (
+        tmpdir.join('content.tar.gz'), name) for name in
+        ['beta/Hello.tid', 'alpha/fnord.css']]
+
+    import_one('testarchive', str(recipe), store)
+    titles = sorted(tiddler.title
+            for tiddler in store.list_bag_tiddlers(bag))
+    assert titles == ['Hello', 'fnord.css']
+
+
+def test_compressed_tar_out_of_order(tmpdir):
+    path = str(tmpdir.join('many.tar.gz'))
+    archive = tarfile.open(path, 'w:gz')
+    for index in range(1500):
+        source = tmpdir.join('t%04d.tid' % index)
+        source.write('modifier: test\n\ntext %s' % index)
+        archive.add(str(source), 'many/t%04d.tid' % index)
+    archive.close()
+    context = ImportContext()
+
+    for index in reversed(range(1500)):
+        tiddler = url_to_tiddler('%s!/many/t%04d.tid' % (path, index),
+                context=context)
+        assert tiddler.text == 'text %s' % index
+
+    # decompressed once, in order, then read from the spool
+    spooled = context.archive('file://' + path)
+    assert spooled._tar is None
+    context.close()
+    assert spooled._spool.closed
+    assert spooled._file.closed
+
+
+def test_context_closes_archives(tmpdir):
+    context = ImportContext()
+    archive = context.archive('file://' + _make_zip(tmpdir))
+    assert archive.open('alpha/Welcome.tid').read()
+
+    context.close()
+    assert archive._file.closed
@@ -0,0 +1,192 @@
+"""
+Test that imports keep a bounded number of parsed tiddlers waiting
+for a slow store.
+"""
+
+import os
+import threading
+import time
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.twimport import (ImportBuffer, ImportAborted,
+        ImportContext, import_manifest, _source_tiddlers)
+
+SAMPLES = os.path.abspath('test/samples')
+
+
+class SlowStore(object):
+    """
+    Wrap a store to make putting tiddlers slow.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.environ = store.environ
+        self.titles = []
+
+    def put(self, thing):
+        time.sleep(0.01)
+        self.titles.append(thing.title)
+        self.store.put(thing)
+
+
+def _tiddler(title, text='x'):
+    tiddler = Tiddler(title)
+    tiddler.text = text
+    return tiddler
+
+
+def setup_module(module):
+    module.store = Store(config['server_store'][0],
+            config['server_store'][1], {'tiddlyweb.config': config})
+    bag = Bag('testbuffer')
+    try:
+        module.store.delete(bag)
+    except NoBagError:
+        pass
+    module.store.put(bag)
+
+
+def test_buffer_order_and_limits():
+    buffer = ImportBuffer(max_items=2, max_bytes=1000)
+    buffer.put(1, _tiddler('later'))
+    buffer.put(1, _tiddler('later2'))
+    blocked = []
+
+    def put_more():
+        blocked.append(buffer.put(1, _tiddler('later3')))
+
+    thread = threading.Thread(target=put_more)
+    thread.start()
+    time.sleep(0.05)
+    assert not blocked
+
+    # the current source may always make progress
+    buffer.put(0, _tiddler('first'))
+    buffer.finish(0, 0.1)
+    assert buffer.get().title == 'first'
+    assert buffer.get() is None
+    assert buffer.advance() == (0.1, None)
+
+    assert buffer.get().title == 'later'
+    thread.join()
+    assert blocked[0] > 0
+    assert buffer.get().title == 'later2'
+    assert buffer.get().title == 'later3'
+    assert buffer.peak_items == 3
+
+
+def test_buffer_bytes():
+    buffer = ImportBuffer(max_items=100, max_bytes=10)
+    buffer.put(1, _tiddler('a', 'xxxx'))
+    buffer.abort()
+    try:
+        buffer.put(1, _tiddler('b', 'xxxx'))
+        assert False, 'should have been aborted'
+    except ImportAborted:
+        pass
+
+
+def test_import_with_small_buffer(tmpdir):
+    for index in range(20):
+        tmpdir.join('tiddler%02d.tid' % index).write(
+                'modifier: test\n\ntext %s' % index)
+    tmpdir.join('tiddler05.tid').write('modifier: test\n\noverridden')
+    urls = [str(tmpdir.join('tiddler%02d.tid' % index))
+            for index in range(20)]
+    urls.extend(['%s/tiddlers.wiki' % SAMPLES, '%s/tw5.html' % SAMPLES,
+        str(tmpdir.join('tiddler05.tid'))])
+    slow_store = SlowStore(store)
+
+    report = import_manifest([('testbuffer', urls)], slow_store,
+            processes=4, max_items=3, max_bytes=1024 * 1024)
+
+    assert report.tiddler_count == 20 + 9 + 5 + 1
+    assert report.peak_items <= 4
+    expected = ['tiddler%02d' % index for index in range(20)]
+    assert slow_store.titles[:20] == expected
+    assert slow_store.titles[-1] == 'tiddler05'
+    tiddler = store.get(Tiddler('tiddler05', 'testbuffer'))
+    assert tiddler.text == 'overridden'
+
+
+def test_wiki_sources_stream():
+    for name in ['tiddlers.wiki', 'tiddlers.html', 'tw5.html']:
+        tiddlers = _source_tiddlers('%s/%s' % (SAMPLES, name),
+                ImportContext())
+        assert not isinstance(tiddlers, list)
+        assert next(tiddlers).title
+
+
+def test_import_error_stops(tmpdir):
+    tmpdir.join('good.tid').write('modifier: test\n\ngood')
+    urls = [str(tmpdir.join('good.tid')), str(tmpdir.join('missing.tid')),
+            str(tmpdir.join('good.tid'))]
+    slow_store = SlowStore(store)
+
+    try:
+        import_manifest([('testbuffer', urls)], slow_store, processes=2)
+        assert False, 'should have raised'
+    except (IOError, OSError, ValueError):
+        pass
+    assert slow_store.titles == ['good']
+
+
+def test_buffer_reserve():
+    buffer = ImportBuffer(max_items=100, max_bytes=10)
+    assert buffer.reserve(1, 8)
+    assert not buffer.reserve(2, 8, wait=False)
+    # the current source may always read
+    assert buffer.reserve(0, 8, wait=False)
+    reserved = []
+
+    def reserve_more():
+        reserved.append(buffer.reserve(2, 8))
+
+    thread = threading.Thread(target=reserve_more)
+    thread.start()
+    time.sleep(0.05)
+    assert not reserved
+    buffer.unreserve(8)
+    buffer.unreserve(8)
+    thread.join()
+    assert reserved == [True]
+    assert buffer.reserved == 8
+    assert buffer.peak_bytes == 16
+
+
+def test_sources_count_against_bytes(tmpdir):
+    wiki = os.path.join(SAMPLES, 'tiddlers.wiki')
+    size = os.path.getsize(wiki)
+    urls = []
+    for index in range(6):
+        copy = tmpdir.join('copy%s.wiki' % index)
+        copy.write_binary(open(wiki, 'rb').read())
+        urls.append(str(copy))
+    slow_store = SlowStore(store)
+
+    report = import_manifest([('testbuffer', urls)], slow_store,
+            processes=4, max_bytes=size // 2)
+
+    assert report.tiddler_count == 6 * 9
+    # only the source being stored goes past the limit
+    assert size <= report.peak_bytes <= size + size // 2
+
+
+def test_context_cache_bounded():
+    context = ImportContext(cache_bytes=10)
+    loads = []
+
+    def load(value):
+        loads.append(value)
+        return value
+
+    context.cached('a', lambda: load(b'xxxxxx'))
+    context.cached('b', lambda: load(b'yyyyyy'))
+    context.cached('b', lambda: load(b'yyyyyy'))
+    context.cached('a', lambda: load(b'xxxxxx'))
+    assert loads == [b'xxxxxx', b'yyyyyy', b'xxxxxx']
@@ -0,0 +1,133 @@
+"""
+Test reading compressed sources, local and remote.
+"""
+
+import gzip
+import shutil
+import threading
+import zlib
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from tiddlywebplugins.twimport import (url_to_tiddler, wiki_to_tiddlers,
+        recipe_to_urls, get_url_handle, ImportContext, _DecodedHandle)
+
+TID = b'modifier: cdent\ntags: squeezed\n\n' + b'compressed text ' * 1000
+
+
+def _gzip(source, target):
+    with open(source, 'rb') as infile:
+        outfile = gzip.open(target, 'wb')
+        shutil.copyfileobj(infile, outfile)
+        outfile.close()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        accepted = self.headers.get('accept-encoding', '')
+        if self.path.endswith('.meta') or 'gzip' not in accepted:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.path == '/raw.tid':
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+            body = compressor.compress(TID) + compressor.flush()
+            encoding = 'deflate'
+        else:
+            body = gzip_bytes(TID)
+            encoding = 'gzip'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def gzip_bytes(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def setup_module(module):
+    module.server = HTTPServer(('127.0.0.1', 0), Handler)
+    module.base = 'http://127.0.0.1:%s' % module.server.server_address[1]
+    thread = threading.Thread(target=module.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def teardown_module(module):
+    module.server.shutdown()
+
+
+def test_local_gz_tiddler(tmpdir):
+    target = str(tmpdir.join('Welcome.tid.gz'))
+    _gzip('test/samples/alpha/Welcome.tid', target)
+
+    tiddler = url_to_tiddler(target)
+
+    assert tiddler.title == 'Welcome'
+    assert 'hello' in tiddler.tags
+
+
+def test_local_gz_wiki(tmpdir):
+    target = str(tmpdir.join('tiddlers.html.gz'))
+    _gzip('test/samples/tiddlers.html', target)
+
+    tiddlers = wiki_to_tiddlers(target)
+
+    assert len(tiddlers) == 9
+
+
+def test_local_gz_recipe(tmpdir):
+    tmpdir.join('Hello.tid').write('tags: one\n\nhi')
+    recipe = tmpdir.join('index.recipe')
+    recipe.write('tiddler: Hello.tid\n')
+    _gzip(str(recipe), str(tmpdir.join('index.recipe.gz')))
+
+    urls = recipe_to_urls(str(tmpdir.join('index.recipe.gz')))
+
+    assert urls == ['file://%s' % tmpdir.join('Hello.tid')]
+
+
+def test_remote_gzip():
+    context = ImportContext()
+    tiddler = url_to_tiddler(base + '/squeezed.tid', context=context)
+
+    assert tiddler.title == 'squeezed'
+    assert tiddler.tags == ['squeezed']
+    assert tiddler.text == (b'compressed text ' * 1000).decode('utf-8').strip()
+
+
+def test_remote_raw_deflate():
+    tiddler = url_to_tiddler(base + '/raw.tid')
+
+    assert tiddler.title == 'raw'
+    assert tiddler.tags == ['squeezed']
+
+
+def test_streaming_reads(tmpdir):
+    target = str(tmpdir.join('Big.tid.gz'))
+    handle = gzip.open(target, 'wb')
+    handle.write(TID)
+    handle.close()
+
+    url, handle = get_url_handle(target)
+    assert url.endswith('/Big.tid')
+    assert isinstance(handle, _DecodedHandle)
+    chunks = []
+    while True:
+        chunk = handle.read(1000)
+        if not chunk:
+            break
+        assert len(chunk) <= 1000
+        chunks.append(chunk)
+    assert b''.join(chunks) == TID
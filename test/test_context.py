@@ -0,0 +1,44 @@
+"""
+Test sharing parsers and serializers through an ImportContext.
+"""
+
+import threading
+
+from tiddlywebplugins.twimport import (ImportContext, url_to_tiddler,
+        wiki_to_tiddlers)
+
+
+def test_context_reuses_instances():
+    context = ImportContext()
+
+    assert context.parser() is context.parser()
+    assert context.serializer() is context.serializer()
+
+
+def test_context_per_thread():
+    context = ImportContext()
+    found = []
+
+    def work():
+        found.append((context.parser(), context.serializer()))
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+
+    assert found[0][0] is not context.parser()
+    assert found[0][1] is not context.serializer()
+
+
+def test_context_threaded_through():
+    context = ImportContext()
+
+    tid = url_to_tiddler('test/samples/alpha/Welcome.tid', context=context)
+    tiddler = url_to_tiddler('test/samples/alpha/Greetings.tiddler',
+            context=context)
+    tiddlers = wiki_to_tiddlers('test/samples/tiddlers.wiki', context=context)
+
+    assert tid.title == 'Welcome'
+    assert 'hello' in tid.tags
+    assert tiddler.title == 'Greetings'
+    assert len(tiddlers) == 9
@@ -0,0 +1,199 @@
+"""
+Test the limits and retries of the FetchScheduler against a local
+HTTP server.
+"""
+
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from tiddlywebplugins.twimport import (FetchScheduler, ImportContext,
+        ImportTracer, url_to_tiddler, _retry_after)
+
+STATE = {'failures': 0, 'active': 0, 'most': 0, 'requests': []}
+LOCK = threading.Lock()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        with LOCK:
+            STATE['requests'].append((self.path, time.time()))
+            STATE['active'] += 1
+            STATE['most'] = max(STATE['most'], STATE['active'])
+        try:
+            if self.path == '/unavailable.tid' or (
+                    self.path == '/throttled.tid' and STATE['failures'] < 2):
+                STATE['failures'] += 1
+                self.send_response(503)
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+                return
+            if self.path.endswith('.meta'):
+                self.send_response(404)
+                self.end_headers()
+                return
+            if self.path == '/slow.tid':
+                time.sleep(0.1)
+            if self.path == '/chunked.tid':
+                self.protocol_version = 'HTTP/1.1'
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                for chunk in [b'tags: remote\n\n', b'hello world']:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.write(b'0\r\n\r\n')
+                return
+            body = b'tags: remote\n\nhello'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.path == '/slowbody.tid':
+                self.wfile.flush()
+                time.sleep(0.3)
+            self.wfile.write(body)
+        finally:
+            with LOCK:
+                STATE['active'] -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def setup_module(module):
+    module.server = Server(('127.0.0.1', 0), Handler)
+    module.base = 'http://127.0.0.1:%s' % module.server.server_address[1]
+    thread = threading.Thread(target=module.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def teardown_module(module):
+    module.server.shutdown()
+
+
+def setup_function(function):
+    STATE.update(failures=0, active=0, most=0, requests=[])
+
+
+def test_retry_throttled():
+    context = ImportContext(scheduler=FetchScheduler(backoff=0.01))
+    tiddler = url_to_tiddler(base + '/throttled.tid', context=context)
+
+    assert tiddler.text == 'hello'
+    assert tiddler.tags == ['remote']
+    paths = [path for path, _ in STATE['requests']]
+    assert paths.count('/throttled.tid') == 3
+
+
+def test_give_up():
+    scheduler = FetchScheduler(retries=1, backoff=0.01)
+    try:
+        scheduler.open(base + '/throttled.tid')
+        assert False, 'should have raised'
+    except IOError as exc:
+        assert exc.code == 503
+
+
+def test_give_up_once():
+    context = ImportContext(scheduler=FetchScheduler(retries=2,
+        backoff=0.01))
+    try:
+        url_to_tiddler(base + '/unavailable.tid', context=context)
+        assert False, 'should have raised'
+    except ValueError as exc:
+        assert '503' in str(exc)
+    assert len(STATE['requests']) == 3
+
+
+def test_host_limit():
+    scheduler = FetchScheduler(host_limit=2)
+
+    def fetch():
+        scheduler.open(base + '/slow.tid').read()
+
+    threads = [threading.Thread(target=fetch) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(STATE['requests']) == 6
+    assert STATE['most'] <= 2
+
+
+def test_plugin_with_host_limit_one():
+    context = ImportContext(scheduler=FetchScheduler(host_limit=1))
+    result = []
+
+    def fetch():
+        result.append(url_to_tiddler(base + '/plugin.js', context=context))
+
+    thread = threading.Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert result[0].title == 'plugin'
+    assert result[0].type == 'text/javascript'
+    assert [path for path, _ in STATE['requests']] == [
+            '/plugin.js', '/plugin.js.meta']
+
+
+def test_chunked_response():
+    context = ImportContext(scheduler=FetchScheduler(host_limit=1))
+    tiddler = url_to_tiddler(base + '/chunked.tid', context=context)
+
+    assert tiddler.text == 'hello world'
+    assert tiddler.tags == ['remote']
+    # the slot was given back
+    url_to_tiddler(base + '/chunked.tid', context=context)
+
+
+def test_fetch_span_covers_body():
+    tracer = ImportTracer()
+    context = ImportContext(tracer=tracer)
+    tiddler = url_to_tiddler(base + '/slowbody.tid', context=context)
+
+    assert tiddler.text == 'hello'
+    spans = dict((event['name'], event['dur']) for event in tracer.events
+            if event['ph'] == 'X')
+    assert spans['fetch'] >= 250000
+    assert spans['parse'] < 250000
+
+
+def test_rate_limit():
+    scheduler = FetchScheduler(rate=20, burst=1)
+    start = time.time()
+    for _ in range(5):
+        scheduler.open(base + '/fast.tid').read()
+
+    assert time.time() - start >= 0.19
+
+
+def test_retry_after_values():
+    assert _retry_after({'retry-after': '3'}) == 3
+    assert _retry_after({}) is None
+    assert _retry_after({'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == 0
+    assert _retry_after({'retry-after': 'soon'}) is None
+
+
+def test_backoff_grows():
+    scheduler = FetchScheduler(backoff=1)
+    for attempt in range(4):
+        delay = scheduler.delay(attempt)
+        assert 2 ** attempt / 2.0 <= delay <= 2 ** attempt
@@ -0,0 +1,160 @@
+"""
+Test importing some tiddlers from a large wiki using its index.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.twimport import (import_one, wiki_index,
+        wiki_to_tiddlers, ImportContext, INDEX_EXTENSION)
+
+SAMPLES = os.path.abspath('test/samples')
+
+
+def setup_module(module):
+    module.store = Store(config['server_store'][0],
+            config['server_store'][1], {'tiddlyweb.config': config})
+    try:
+        module.store.delete(Bag('testindex'))
+    except NoBagError:
+        pass
+    module.store.put(Bag('testindex'))
+
+
+def _copy_wiki(tmpdir, name='tiddlers.wiki'):
+    path = str(tmpdir.join(name))
+    shutil.copy(os.path.join(SAMPLES, name), path)
+    return path
+
+
+def _saved_index(index_dir):
+    names = os.listdir(index_dir)
+    assert len(names) == 1
+    assert names[0].endswith(INDEX_EXTENSION)
+    handle = open(os.path.join(index_dir, names[0]))
+    try:
+        return json.load(handle)
+    finally:
+        handle.close()
+
+
+def test_index_matches_full_parse(tmpdir):
+    path = _copy_wiki(tmpdir)
+    index = wiki_index(path)
+    assert os.listdir(str(tmpdir)) == ['tiddlers.wiki']
+
+    full = dict((tiddler.title, tiddler) for tiddler in
+            wiki_to_tiddlers(path))
+    assert sorted(index.keys()) == sorted(full.keys())
+
+    titles = ['oog', 'DiffFormatterPlugin', 'codeblocked']
+    tiddlers = wiki_to_tiddlers(path, titles=titles)
+    assert [tiddler.title for tiddler in tiddlers] == titles
+    for tiddler in tiddlers:
+        assert tiddler.text == full[tiddler.title].text
+        assert tiddler.tags == full[tiddler.title].tags
+        assert tiddler.modifier == full[tiddler.title].modifier
+
+
+def test_import_fragment_writes_nothing_by_default():
+    before = sorted(os.listdir(SAMPLES))
+    import_one('testindex', '%s/tiddlers.wiki#oog' % SAMPLES, store)
+
+    assert sorted(os.listdir(SAMPLES)) == before
+    tiddler = store.get(Tiddler('oog', 'testindex'))
+    assert tiddler.text.startswith('basically')
+
+
+def test_import_fragment_with_index_dir(tmpdir):
+    path = _copy_wiki(tmpdir)
+    index_dir = str(tmpdir.join('index'))
+    context = ImportContext(index_dir=index_dir)
+    import_one('testindex', path + '#codeblocked', store, context=context)
+
+    saved = _saved_index(index_dir)
+    assert 'codeblocked' in saved['tiddlers']
+    assert saved['size'] == os.stat(path).st_size
+    tiddler = store.get(Tiddler('codeblocked', 'testindex'))
+    assert tiddler.text == wiki_to_tiddlers(path,
+            titles=['codeblocked'])[0].text
+
+    import_one('testindex', path + '#NoSuchTiddler', store,
+            context=ImportContext(index_dir=index_dir))
+    bag = store.get(Bag('testindex'))
+    titles = [tiddler.title for tiddler in store.list_bag_tiddlers(bag)]
+    assert 'NoSuchTiddler' not in titles
+
+
+def test_index_rebuilt_when_wiki_changes(tmpdir):
+    path = _copy_wiki(tmpdir)
+    index_dir = str(tmpdir.join('index'))
+    wiki_index(path, index_dir)
+
+    handle = open(path, 'rb')
+    content = handle.read()
+    handle.close()
+    content = content.replace(b'<div title="oog"',
+            b'<div title="Extra" modifier="test">\n<pre>extra</pre>\n</div>\n'
+            b'<div title="oog"')
+    handle = open(path, 'wb')
+    handle.write(content)
+    handle.close()
+
+    index = wiki_index(path, index_dir)
+    assert 'Extra' in index
+    assert 'Extra' in _saved_index(index_dir)['tiddlers']
+    tiddlers = wiki_to_tiddlers(path, titles=['Extra', 'oog'])
+    assert [tiddler.text for tiddler in tiddlers] == ['extra',
+            'basically a positive expression of "I am primitive man"']
+
+
+def test_index_refreshed_when_only_mtime_changes(tmpdir):
+    path = _copy_wiki(tmpdir)
+    index_dir = str(tmpdir.join('index'))
+    first = wiki_index(path, index_dir)
+    os.utime(path, (1, 1))
+    assert wiki_index(path, index_dir) == first
+    assert _saved_index(index_dir)['mtime'] == 1
+    assert wiki_index(path, index_dir) == first
+
+
+def test_tw5_not_indexed(tmpdir):
+    path = _copy_wiki(tmpdir, 'tw5.html')
+    assert wiki_index(path) is None
+    title = list(wiki_to_tiddlers(path))[0].title
+    tiddlers = list(wiki_to_tiddlers(path, titles=[title]))
+    assert title in [tiddler.title for tiddler in tiddlers]
+
+
+def test_index_written_by_many_threads(tmpdir, caplog):
+    caplog.set_level(logging.DEBUG, logger='tiddlywebplugins.twimport')
+    path = _copy_wiki(tmpdir)
+    index_dir = str(tmpdir.join('index'))
+    errors = []
+
+    def index():
+        try:
+            for _ in range(10):
+                os.utime(path, None)
+                wiki_index(path, index_dir)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=index) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert 'unable to save' not in caplog.text
+    assert 'oog' in wiki_index(path, index_dir)
+    assert 'oog' in _saved_index(index_dir)['tiddlers']
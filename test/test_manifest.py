@@ -0,0 +1,83 @@
+"""
+Test importing many sources into many bags from a manifest.
+"""
+
+import os
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.twimport import (import_manifest, import_list,
+        manifest_to_list)
+
+SAMPLES = os.path.abspath('test/samples')
+
+
+def setup_module(module):
+    module.store = Store(config['server_store'][0],
+            config['server_store'][1], {'tiddlyweb.config': config})
+    for name in ['manifestone', 'manifesttwo']:
+        bag = Bag(name)
+        try:
+            module.store.delete(bag)
+        except NoBagError:
+            pass
+        module.store.put(bag)
+
+
+def test_manifest_to_list(tmpdir):
+    manifest = tmpdir.join('build.manifest')
+    manifest.write("""# a comment
+manifestone: %s/alpha/Welcome.tid
+manifesttwo: %s/tiddlers.wiki#codeblocked
+
+manifestone: Welcome.tid
+""" % (SAMPLES, SAMPLES))
+
+    bags = manifest_to_list(str(manifest))
+
+    assert [bag_name for bag_name, _ in bags] == ['manifestone',
+            'manifesttwo']
+    assert bags[0][1][0] == 'file://%s/alpha/Welcome.tid' % SAMPLES
+    assert bags[0][1][1] == 'file://%s' % tmpdir.join('Welcome.tid')
+    assert bags[1][1] == ['file://%s/tiddlers.wiki#codeblocked' % SAMPLES]
+
+
+def test_import_manifest(tmpdir):
+    tmpdir.join('Welcome.tid').write('tags: override\n\nlater wins')
+    manifest = [
+            ('manifestone', ['%s/beta/buried/short.recipe' % SAMPLES,
+                '%s/alpha/Welcome.tid' % SAMPLES,
+                str(tmpdir.join('Welcome.tid'))]),
+            ('manifesttwo', ['%s/tiddlers.wiki#codeblocked' % SAMPLES,
+                '%s/alpha/Greetings.tiddler' % SAMPLES]),
+    ]
+    lines = []
+
+    report = import_manifest(manifest, store, processes=3,
+            progress=lines.append)
+
+    assert report.tiddler_count == 5
+    assert len(lines) == 5
+    assert lines[0].startswith('[1/5] manifestone: ')
+    assert 'into 2 bags' in report.summary()
+
+    titles = [tiddler.title for tiddler
+            in store.list_bag_tiddlers(Bag('manifestone'))]
+    assert sorted(titles) == ['Welcome', 'hole']
+    tiddler = store.get(Tiddler('Welcome', 'manifestone'))
+    assert tiddler.text == 'later wins'
+
+    titles = [tiddler.title for tiddler
+            in store.list_bag_tiddlers(Bag('manifesttwo'))]
+    assert sorted(titles) == ['Greetings', 'codeblocked']
+
+
+def test_import_list_report():
+    report = import_list('manifesttwo', ['%s/alpha/Welcome.tid' % SAMPLES],
+            store, processes=1)
+
+    assert report.tiddler_count == 1
+    assert report.entries[0][0] == 'manifesttwo'
@@ -0,0 +1,93 @@
+"""
+Test planning an import without saving anything.
+"""
+
+import os
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.twimport import plan_list, plan_manifest
+
+SAMPLES = os.path.abspath('test/samples')
+
+
+def setup_module(module):
+    module.store = Store(config['server_store'][0],
+            config['server_store'][1], {'tiddlyweb.config': config})
+    for name in ['testplan', 'testplannew']:
+        bag = Bag(name)
+        try:
+            module.store.delete(bag)
+        except NoBagError:
+            pass
+    module.store.put(Bag('testplan'))
+    for title in ['Hello', 'oog']:
+        tiddler = Tiddler(title, 'testplan')
+        tiddler.text = 'old'
+        module.store.put(tiddler)
+
+
+def test_plan_recipe_and_wiki(tmpdir):
+    tmpdir.join('Hello.tid').write('tags: one\n\nhello')
+    tmpdir.join('style.css').write('body {}')
+    recipe = tmpdir.join('index.recipe')
+    recipe.write('tiddler: Hello.tid\ntiddler: style.css\n'
+            'recipe: %s/beta/buried/short.recipe\n' % SAMPLES)
+
+    plan = plan_list('testplan', [str(recipe),
+        '%s/tiddlers.wiki#oog codeblocked' % SAMPLES], store)
+
+    assert not plan.errors
+    assert plan.tiddler_count == 5
+    assert sorted(plan.overwrites) == [('testplan', 'Hello'),
+            ('testplan', 'oog')]
+    assert sorted(title for _, title in plan.new) == ['codeblocked', 'hole',
+            'style.css']
+    # two recipes, tid, css and its .meta, js and its .meta, wiki
+    assert plan.fetch_count == 8
+    assert plan.byte_count == (len('tags: one\n\nhello') + len('body {}')
+            + os.stat('%s/beta/buried/hole.js' % SAMPLES).st_size
+            + os.stat('%s/tiddlers.wiki' % SAMPLES).st_size)
+
+    report = plan.report()
+    assert 'total: 5 tiddlers (2 overwrite existing, 3 new)' in report
+    assert '    testplan/Hello' in report
+
+    # nothing was saved
+    tiddler = store.get(Tiddler('Hello', 'testplan'))
+    assert tiddler.text == 'old'
+
+
+def test_plan_titles_match_import():
+    plan = plan_manifest([('testplannew', ['%s/tiddlers.html' % SAMPLES,
+        '%s/tw5.html' % SAMPLES, '%s/tiddlers.json' % SAMPLES])], store)
+
+    titles = plan.entries[0][2]
+    assert len(titles) == 9
+    assert 'TiddlyWebAdaptor' in titles
+    assert plan.entries[1][2] == ['$:/core', 'HelloThere', 'Empty',
+            'SecondStore', 'dot.png']
+    assert plan.entries[2][2] == ['Alpha', 'Beta']
+    assert not plan.overwrites
+    assert len(plan.new) == 16
+
+
+def test_plan_missing_source():
+    plan = plan_list('testplan', ['%s/missing.tid' % SAMPLES], store)
+
+    assert plan.tiddler_count == 0
+    assert len(plan.errors) == 1
+    assert 'ERROR' in plan.report()
+
+
+def test_plan_missing_recipe(tmpdir):
+    tmpdir.join('good.tid').write('modifier: test\n\ngood')
+    plan = plan_list('testplan', ['%s/missing.recipe' % SAMPLES,
+        str(tmpdir.join('good.tid'))], store)
+
+    assert plan.tiddler_count == 1
+    assert plan.errors[0][0] == '%s/missing.recipe' % SAMPLES
+    assert 'ERROR' in plan.report()
@@ -0,0 +1,86 @@
+"""
+Test writing trace events and profiles for an import run.
+"""
+
+import json
+import os
+import pstats
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+from tiddlyweb.model.bag import Bag
+
+from tiddlywebplugins.twimport import import_list, ImportTracer
+
+SAMPLES = os.path.abspath('test/samples')
+
+
+def setup_module(module):
+    module.store = Store(config['server_store'][0],
+            config['server_store'][1], {'tiddlyweb.config': config})
+    bag = Bag('testtrace')
+    try:
+        module.store.delete(bag)
+    except NoBagError:
+        pass
+    module.store.put(bag)
+
+
+def test_tracer_spans():
+    tracer = ImportTracer()
+    with tracer.span('fetch', 'http://example.com/', size=3):
+        pass
+
+    assert tracer.events[0]['ph'] == 'M'
+    event = tracer.events[1]
+    assert event['name'] == 'fetch'
+    assert event['ph'] == 'X'
+    assert event['dur'] >= 0
+    assert event['args'] == {'url': 'http://example.com/', 'size': 3}
+
+
+def test_import_trace(tmpdir):
+    trace = str(tmpdir.join('trace.json'))
+    profile = str(tmpdir.join('import.prof'))
+
+    report = import_list('testtrace', [
+        '%s/beta/buried/short.recipe' % SAMPLES,
+        '%s/alpha/Welcome.tid' % SAMPLES,
+        '%s/tiddlers.wiki' % SAMPLES], store, processes=2,
+        trace=trace, profile=profile)
+
+    assert report.tiddler_count == 11
+    data = json.load(open(trace))
+    spans = [event for event in data['traceEvents'] if event['ph'] == 'X']
+    names = set(event['name'] for event in spans)
+    assert names == set(['recipe', 'source', 'fetch', 'meta probe', 'parse',
+        'store'])
+    stores = [event for event in spans if event['name'] == 'store']
+    assert len(stores) == 11
+    probes = [event['args']['url'] for event in spans
+            if event['name'] == 'meta probe']
+    assert probes == ['file://%s/beta/buried/hole.js.meta' % SAMPLES]
+
+    stats = pstats.Stats(profile)
+    functions = [function[2] for function in stats.stats]
+    assert 'url_to_tiddler' in functions
+    assert '_get_tiddler_from_div' in functions
+
+
+def test_parse_spans_cover_parsing(tmpdir):
+    tiddlers = ',\n'.join('{"title": "t%s", "text": "%s"}' % (index,
+        'x' * 100) for index in range(2000))
+    tmpdir.join('many.json').write('[%s]' % tiddlers)
+    trace = str(tmpdir.join('trace.json'))
+
+    import_list('testtrace', [str(tmpdir.join('many.json')),
+        '%s/tw5.html' % SAMPLES], store, processes=1, trace=trace)
+
+    data = json.load(open(trace))
+    parses = [event for event in data['traceEvents']
+            if event['name'] == 'parse']
+    urls = set(event['args']['url'] for event in parses)
+    assert urls == set(['file://%s' % tmpdir.join('many.json'),
+        'file://%s/tw5.html' % SAMPLES])
+    # a span for each tiddler made, and one for finding there are no more
+    assert len(parses) == 2001 + 5 + 1
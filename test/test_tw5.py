@@ -0,0 +1,125 @@
+"""
+Test importing TiddlyWiki 5 tiddler stores and JSON bundles.
+"""
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.twimport import (wiki_to_tiddlers, json_to_tiddlers,
+        json_string_to_tiddlers, wiki_string_to_tiddlers, import_one,
+        ImportContext, ImportTracer)
+
+TW5_FILE = 'test/samples/tw5.html'
+JSON_FILE = 'test/samples/tiddlers.json'
+
+
+def test_tw5_to_tiddlers():
+    tiddlers = list(wiki_to_tiddlers(TW5_FILE))
+
+    titles = [tiddler.title for tiddler in tiddlers]
+    assert titles == ['$:/core', 'HelloThere', 'Empty', 'SecondStore',
+            'dot.png']
+
+    hello = tiddlers[1]
+    assert hello.text == 'Welcome to <b>TiddlyWiki 5</b>'
+    assert sorted(hello.tags) == ['one', 'two words']
+    assert hello.created == '20140121103226'
+    assert hello.modified == '20140121103426'
+    assert hello.modifier == 'cdent'
+    assert hello.fields['color'] == 'red'
+    assert 'title' not in hello.fields
+
+    core = tiddlers[0]
+    assert core.type == 'application/json'
+    assert core.fields['plugin-type'] == 'plugin'
+
+    assert tiddlers[2].text == ''
+    assert tiddlers[3].fields['list'] == 'HelloThere Empty'
+
+    image = tiddlers[4]
+    assert image.type == 'image/png'
+    assert image.text.startswith(b'\x89PNG')
+
+
+def test_tw2_mentioning_store_class():
+    tiddlers = wiki_string_to_tiddlers('<html><body><div id="storeArea">'
+            '<div title="Notes"><pre>see tiddlywiki-tiddler-store'
+            '</pre></div></div></body></html>')
+
+    assert [tiddler.title for tiddler in tiddlers] == ['Notes']
+    assert tiddlers[0].text == 'see tiddlywiki-tiddler-store'
+
+
+def test_json_to_tiddlers():
+    tiddlers = list(json_to_tiddlers(JSON_FILE))
+
+    assert [tiddler.title for tiddler in tiddlers] == ['Alpha', 'Beta']
+    assert tiddlers[0].tags == ['a', 'b c']
+    assert tiddlers[1].type == 'text/x-markdown'
+    assert tiddlers[1].created == '20200101000000'
+    assert tiddlers[1].modified == '20200101000000'
+
+
+def test_json_single_tiddler():
+    tiddlers = list(json_string_to_tiddlers(
+        ' {"title": "One", "text": "only"}'))
+
+    assert len(tiddlers) == 1
+    assert tiddlers[0].text == 'only'
+
+
+def test_plain_json_is_one_tiddler(tmpdir):
+    tmpdir.join('settings.json').write('{"a": 1}')
+    tmpdir.join('numbers.json').write('[1, 2, 3]')
+
+    for name in ['settings', 'numbers']:
+        context = ImportContext(tracer=ImportTracer())
+        tiddlers = list(json_to_tiddlers(str(tmpdir.join('%s.json' % name)),
+            context=context))
+        fetches = [event for event in context.tracer.events
+                if event['name'] == 'fetch']
+        assert len(fetches) == 1
+        assert len(tiddlers) == 1
+        assert tiddlers[0].title == '%s.json' % name
+        assert tiddlers[0].type == 'application/json'
+
+
+def test_json_text_types_kept():
+    tiddlers = list(json_string_to_tiddlers('[{"title": "List", '
+        '"type": "application/x-tiddlers", "text": "abcd"}, '
+        '{"title": "Refs", "type": "application/x-bibtex", "text": "@a{b}"}, '
+        '{"title": "Icon", "type": "image/svg+xml", "text": "<svg/>"}]'))
+
+    assert [tiddler.text for tiddler in tiddlers] == ['abcd', '@a{b}',
+            '<svg/>']
+
+
+def test_json_bundle_bad_item():
+    try:
+        list(json_string_to_tiddlers('[{"title": "One"}, 2]'))
+        assert False, 'should have raised'
+    except ValueError:
+        pass
+
+
+def test_import_tw5_fragment():
+    store = Store(config['server_store'][0],
+            config['server_store'][1], {'tiddlyweb.config': config})
+    bag = Bag('testtw5')
+    try:
+        store.delete(bag)
+    except NoBagError:
+        pass
+    store.put(bag)
+
+    import_one('testtw5', TW5_FILE + '#HelloThere%20dot.png', store)
+    import_one('testtw5', JSON_FILE, store)
+
+    titles = sorted(tiddler.title for tiddler in store.list_bag_tiddlers(bag))
+    assert titles == ['Alpha', 'Beta', 'HelloThere', 'dot.png']
+    image = store.get(Tiddler('dot.png', 'testtw5'))
+    assert image.text.startswith(b'\x89PNG')
+    tiddler = store.get(Tiddler('HelloThere', 'testtw5'))
+    assert tiddler.fields['color'] == 'red'
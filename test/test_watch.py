@@ -0,0 +1,108 @@
+"""
+Test re-importing tiddlers when local recipe sources change.
+"""
+
+import os
+import shutil
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.twimport import (import_list, ImportWatcher,
+        ImportContext, _twimport)
+
+BAG = 'testwatch'
+
+
+def setup_module(module):
+    module.store = Store(config['server_store'][0],
+            config['server_store'][1], {'tiddlyweb.config': config})
+    bag = Bag(BAG)
+    try:
+        module.store.delete(bag)
+    except NoBagError:
+        pass
+    module.store.put(bag)
+
+
+def _write(path, content):
+    handle = open(path, 'w')
+    handle.write(content)
+    handle.close()
+    # make sure the change is visible even on coarse clocks
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+
+def _make_tree(tmpdir):
+    source = str(tmpdir.join('beta'))
+    shutil.copytree('test/samples/beta', source)
+    recipe = os.path.join(source, 'index.recipe')
+    _write(recipe, 'tiddler: Hello.tid\nrecipe: buried/short.recipe\n')
+    return source, recipe
+
+
+def test_watch_map(tmpdir):
+    source, recipe = _make_tree(tmpdir)
+    watcher = ImportWatcher(BAG, [recipe], store)
+
+    paths = set(watcher.targets)
+    assert recipe in paths
+    assert os.path.join(source, 'buried', 'short.recipe') in paths
+    assert os.path.join(source, 'Hello.tid') in paths
+    assert os.path.join(source, 'Hello.tid.meta') in paths
+    assert os.path.join(source, 'buried', 'hole.js') in paths
+    assert os.path.join(source, 'buried', 'hole.js.meta') in paths
+
+
+def test_watch_tiddler_change(tmpdir):
+    source, recipe = _make_tree(tmpdir)
+    import_list(BAG, [recipe], store)
+    watcher = ImportWatcher(BAG, [recipe], store)
+
+    assert watcher.check() == []
+
+    hello = os.path.join(source, 'Hello.tid')
+    _write(hello, 'modifier: cdent\ntags: joy\n\nchanged')
+
+    assert watcher.check() == [hello]
+    tiddler = store.get(Tiddler('Hello', BAG))
+    assert tiddler.text == 'changed'
+    assert tiddler.tags == ['joy']
+
+    assert watcher.check() == []
+
+
+def test_watch_meta_and_recipe_change(tmpdir):
+    source, recipe = _make_tree(tmpdir)
+    import_list(BAG, [recipe], store)
+    watcher = ImportWatcher(BAG, [recipe], store)
+
+    meta = os.path.join(source, 'buried', 'hole.js.meta')
+    _write(meta, 'tags: systemConfig watched\n')
+    assert watcher.check() == [meta]
+    tiddler = store.get(Tiddler('hole', BAG))
+    assert 'watched' in tiddler.tags
+
+    _write(os.path.join(source, 'New.tid'), 'tags: new\n\nfresh')
+    _write(recipe, 'tiddler: Hello.tid\ntiddler: New.tid\n')
+    assert watcher.check() == [recipe]
+    tiddler = store.get(Tiddler('New', BAG))
+    assert tiddler.text == 'fresh'
+    assert os.path.join(source, 'New.tid') in watcher.targets
+    assert os.path.join(source, 'buried', 'hole.js') not in watcher.targets
+
+
+def test_watch_rejects_manifest(tmpdir):
+    manifest = tmpdir.join('site.manifest')
+    manifest.write('%s: %s\n' % (BAG, os.path.abspath(
+        'test/samples/beta/index.recipe')))
+    for options in [{'watch': True, 'manifest': str(manifest)},
+            {'watch': True, 'plan': True}]:
+        try:
+            _twimport(options, [BAG, str(manifest)], store, ImportContext())
+            assert False, 'should have raised'
+        except ValueError as exc:
+            assert '--watch' in '%s' % exc
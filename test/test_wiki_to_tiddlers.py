@@ -5,7 +5,7 @@ test importing a wiki.
 WIKI_HTML_FILE = 'test/samples/tiddlers.html'
 WIKI_WIKI_FILE = 'test/samples/tiddlers.wiki'
 
-from tiddlywebplugins.twimport import wiki_to_tiddlers
+from tiddlywebplugins.twimport import wiki_to_tiddlers, wiki_string_to_tiddlers
 
 
 def test_wiki_wiki_to_tiddlers():
@@ -39,3 +39,16 @@ def test_wiki_html_to_tiddlers():
     assert 'FND' in tag_info['codeblocked']
     for _, values in tag_info.items():
         assert 'None' not in values
+
+def test_unusual_store_area_parsed_whole():
+    content = open(WIKI_WIKI_FILE, 'rb').read().decode('utf-8')
+    tiddlers = wiki_to_tiddlers(WIKI_WIKI_FILE)
+    odd = content.replace('<div id="storeArea">',
+            '<div id="storeArea"><!-- saved -->')
+
+    odd_tiddlers = wiki_string_to_tiddlers(odd)
+
+    assert ([tiddler.title for tiddler in odd_tiddlers] ==
+            [tiddler.title for tiddler in tiddlers])
+    assert ([tiddler.text for tiddler in odd_tiddlers] ==
+            [tiddler.text for tiddler in tiddlers])
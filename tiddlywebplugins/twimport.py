@@ -37,21 +37,148 @@ in the same location. This optional file contains meta
 information about the tiddler, such as tags, modifier, and
 fields. The format is the same as the top section of a .tid
 file.
+
+When developing themes and plugins from a local recipe tree the
+"--watch" option may be given before the bag name:
+
+    twanager twimport --watch mybag path/to/index.recipe
+
+After the initial import, the local files (including .meta files
+and nested recipes) are polled for changes and only the tiddlers
+that come from a changed file are imported again. The polling
+interval, in seconds, may be set with "--watch=0.1". It cannot be
+used with "--manifest" or "--plan".
+
+To build an instance from content in many bags, list the sources
+in a manifest, one per line, with the bag they belong in:
+
+    system: plugins/index.recipe
+    common: http://example.com/common.wiki
+    system: overrides/StyleSheet.tid
+
+and import them all at once, in a shared pool of worker threads:
+
+    twanager twimport --manifest=build.manifest --processes=8
+
+Sources are fetched and parsed in parallel but saved in manifest
+order, so a later source still overrides an earlier one in the same
+bag. Relative paths are relative to the manifest file.
+
+Parsed tiddlers wait to be saved in a buffer of limited size. When
+it is full the workers wait for the store to catch up, so a slow
+store sets the pace without piling up parsed tiddlers. The limits
+may be set with "--buffer-items=1000" and "--buffer-bytes=33554432".
+Wikis and JSON bundles are turned into tiddlers one at a time as
+the buffer takes them. A worker reads the whole of a source before
+parsing it, so the bytes of the sources being read count against
+the same limit: a worker waits for room before reading. The source
+being stored is always let through, so a source larger than the
+limit is still imported, and memory then peaks at about the limit
+plus that source. Remote archives are saved to a temporary file
+rather than held in memory, and recipes and .meta files are cached
+up to a fixed size.
+
+To find out where the time goes in a slow import, "--trace=FILE"
+writes a span for each recipe read, fetch, .meta probe, tiddler
+parsed and store, with its URL, as Trace Event Format JSON which can
+be loaded into chrome://tracing, Perfetto or speedscope. "--profile=FILE"
+runs the import under cProfile and writes pstats data to FILE.
+
+Remote fetching is done through a FetchScheduler, which limits the
+number of simultaneous requests to each host, optionally limits the
+rate of requests to each host and retries throttled or failed
+requests with jittered exponential backoff, honouring any
+Retry-After header. The limits may be set on the command line:
+
+    twanager twimport --host-limit=2 --rate=5 --retries=4 \\
+        --timeout=60 mybag http://example.com/index.recipe
+
+Remote requests ask for gzip or deflate compressed responses, which
+are decompressed as they are read. Local or remote files ending in
+".gz" (for example "index.recipe.gz", "big.html.gz" or "Hello.tid.gz")
+are decompressed the same way and then treated as if the ".gz" were
+not there.
+
+TiddlyWiki 5 files, which keep their tiddlers as JSON in a
+<script class="tiddlywiki-tiddler-store"> block, are imported like
+older TiddlyWikis. So are ".json" files holding a list of tiddlers
+in the same format, as exported by TiddlyWiki 5. Any other ".json"
+file is imported as a single application/json tiddler.
+
+Zip and tar archives (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2")
+may be imported without unpacking them. Naming an archive imports
+every file in it, other than .meta files and recipes, as a tiddler.
+A file inside an archive is named by following the archive with
+"!/" and the path of the file:
+
+    twanager twimport mybag content.tar.gz!/site/index.recipe
+
+Recipes inside an archive may refer to other files in the same
+archive with ordinary relative paths. The archive's index is read
+once per import and files are read straight from it.
+
+To find out what an import would cost before doing it, add "--plan":
+
+    twanager twimport --plan mybag http://example.com/index.recipe
+
+Recipes and archives are expanded, tiddler files are only checked
+with a HEAD request or a stat, and wikis are scanned for titles
+without making tiddlers. The report lists the number of tiddlers,
+bytes and fetches involved and which existing tiddlers in the target
+bags would be overwritten. Nothing is saved.
+
+When a subset of a local TiddlyWiki 2.x file is imported with a
+permaview fragment, an index of the byte offsets of each tiddler in
+the storeArea is made, once per import, and only the requested
+tiddlers are read and parsed. To keep the index between imports,
+name a directory to hold it with "--index-dir=DIR" or with
+'twimport.index_dir' in tiddlywebconfig.py. A saved index is
+checked against the wiki's size, modification time and, if need be,
+SHA-1 digest, and is made again when the wiki has changed. Nothing
+is written beside the wiki.
 """
 
+import base64
+import binascii
+import cProfile
+import hashlib
+import json
+import logging
+import mimetypes
 import os
+import pstats
+import random
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+
+from email.utils import parsedate_tz, mktime_tz
+
+from multiprocessing.pool import ThreadPool
 
 try:
-    from urllib2 import urlopen, URLError, HTTPError
-    from urllib import splittype
+    from urllib2 import urlopen, Request, URLError, HTTPError
+    from urllib import splittype, url2pathname
     from urlparse import urljoin, urlparse, urlunparse
 except ImportError as exc:
-    from urllib.request import urlopen, URLError, HTTPError
+    from urllib.request import (urlopen, Request, URLError, HTTPError,
+            url2pathname)
     from urllib.parse import splittype, urljoin, urlparse, urlunparse
 
 from html5lib import HTMLParser, treebuilders
 
+from tiddlyweb.model.bag import Bag
 from tiddlyweb.model.tiddler import Tiddler, string_to_tags_list
+from tiddlyweb.store import NoBagError
 from tiddlyweb.serializer import Serializer
 from tiddlyweb.manage import make_command
 from tiddlyweb.util import pseudo_binary
@@ -66,6 +193,43 @@ COOK_VARIABLES = {
         'TW_TRUNKDIR': 'https://raw.github.com/TiddlyWiki/tiddlywiki/master',
         'TW_ROOT': 'https://raw.github.com/TiddlyWiki/tiddlywiki/master',
 }
+WATCH_INTERVAL = 0.25
+IMPORT_PROCESSES = 4
+BUFFER_ITEMS = 1000
+BUFFER_BYTES = 32 * 1024 * 1024
+CACHE_BYTES = 4 * 1024 * 1024
+FETCH_HOST_LIMIT = 4
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.5
+FETCH_MAX_DELAY = 120
+FETCH_TIMEOUT = 30
+RETRY_STATUS = [408, 429, 500, 502, 503, 504]
+ACCEPT_ENCODING = 'gzip, deflate'
+ARCHIVE_EXTENSIONS = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2']
+ARCHIVE_SEPARATOR = '!/'
+TW5_STORE_CLASS = 'tiddlywiki-tiddler-store'
+TW5_STORE = re.compile(r'<script\b[^>]*\sclass=["\']%s["\'][^>]*>'
+        % TW5_STORE_CLASS)
+TW5_IGNORED_FIELDS = ['title', 'text', 'tags', 'revision', 'bag']
+# The types TiddlyWiki 5 keeps as base64 text
+TW5_BASE64_PREFIXES = ('image/', 'audio/', 'video/', 'font/')
+TW5_TEXT_IMAGES = ['image/svg+xml']
+TW5_BASE64_TYPES = ['application/pdf', 'application/zip',
+        'application/octet-stream', 'application/epub+zip',
+        'application/font-woff', 'application/font-woff2',
+        'application/x-font-ttf', 'application/x-font-otf',
+        'application/msword', 'application/vnd.ms-excel',
+        'application/vnd.openxmlformats-officedocument.'
+        'wordprocessingml.document',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet']
+WHITESPACE = re.compile(r'\s*')
+STORE_AREA = 'id="storeArea"'
+STORE_AREA_DIV = re.compile(r'\s*<(/?)div\b')
+TIDDLER_DIV = re.compile(r'<div\b[^>]*?\stitle="([^"]*)"')
+INDEX_EXTENSION = '.twindex'
+DECODE_CHUNK = 64 * 1024
+
+LOGGER = logging.getLogger(__name__)
 
 
 def init(config):
@@ -75,95 +239,1560 @@ def init(config):
 
     @make_command()
     def twimport(args):
-        """Import tiddlers, recipes, wikis, binary content: <bag> <URI>"""
-        bag = args[0]
-        urls = args[1:]
-        if not bag or not urls:
-            raise IndexError('missing args')
-        import_list(bag, urls, get_store(config))
+        """Import tiddlers, recipes, wikis, binaries: [options] <bag> <URI>"""
+        options, args = _split_options(args)
+        store = get_store(config)
+        context = ImportContext(store.environ,
+                scheduler=_scheduler_from_options(options),
+                index_dir=options.get('index-dir',
+                    config.get('twimport.index_dir')))
+        try:
+            _twimport(options, args, store, context)
+        finally:
+            context.close()
+
 
+class ImportContext(object):
+    """
+    State shared by all the steps of one import run.
+
+    Parsing TiddlyWiki and .tiddler content requires an html5lib
+    HTMLParser and turning .tid or .meta content into a tiddler
+    requires a text Serializer. Both are expensive to create, so
+    a context keeps one of each per thread and hands them out for
+    as long as the context lives.
+
+    Remote URLs are opened through the context's FetchScheduler.
+    If the context has an ImportTracer, the steps of the import are
+    recorded as spans. If it has an index_dir, wiki indexes are kept
+    there between imports.
+
+    Fetched content is cached up to cache_bytes, the oldest being
+    forgotten first. While a worker of import_manifest has a budget
+    its reads of sources are counted against the ImportBuffer.
+    """
 
-def import_list(bag_name, urls, store):
+    def __init__(self, environ=None, scheduler=None, tracer=None,
+            index_dir=None, cache_bytes=CACHE_BYTES):
+        if environ is None:
+            environ = {}
+        if scheduler is None:
+            scheduler = FetchScheduler()
+        self.environ = environ
+        self.scheduler = scheduler
+        self.tracer = tracer
+        self.index_dir = index_dir
+        self.cache_bytes = cache_bytes
+        self._local = threading.local()
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._cache_lock = threading.Lock()
+
+    def parser(self):
+        """
+        Return the HTMLParser belonging to the current thread.
+        """
+        try:
+            return self._local.parser
+        except AttributeError:
+            parser = HTMLParser(tree=treebuilders.getTreeBuilder('dom'))
+            self._local.parser = parser
+            return parser
+
+    def serializer(self):
+        """
+        Return the text Serializer belonging to the current thread.
+        """
+        try:
+            return self._local.serializer
+        except AttributeError:
+            serializer = Serializer('text', self.environ)
+            self._local.serializer = serializer
+            return serializer
+
+    def parse_html(self, content):
+        """
+        Parse an HTML string to a minidom document.
+        """
+        return self.parser().parse(content)
+
+    def from_text(self, title, content):
+        """
+        Generate a tiddler from an RFC822-style string.
+        """
+        tiddler = Tiddler(title)
+        serializer = self.serializer()
+        serializer.object = tiddler
+        serializer.from_string(content)
+        return tiddler
+
+    def cached(self, key, load):
+        """
+        Return the result of calling load, remembered under key
+        for the life of the context, or until the cache holds more
+        than cache_bytes of content. A failure is remembered too, so
+        a missing .meta file is only looked for once.
+        """
+        with self._cache_lock:
+            if key in self._cache:
+                result, error, _ = self._cache[key]
+                if error:
+                    raise error
+                return result
+        try:
+            result = load()
+        except (HTTPError, URLError, IOError, OSError, ValueError) as exc:
+            self._remember(key, None, exc)
+            raise
+        self._remember(key, result, None)
+        return result
+
+    def _remember(self, key, result, error):
+        """
+        Cache result or error under key, forgetting the oldest
+        content if the cache has grown too big.
+        """
+        size = _cached_size(result)
+        with self._cache_lock:
+            if key in self._cache:
+                return
+            self._cache[key] = (result, error, size)
+            self._cache_size += size
+            if self._cache_size <= self.cache_bytes:
+                return
+            for old_key in list(self._cache):
+                if self._cache_size <= self.cache_bytes:
+                    break
+                old_size = self._cache[old_key][2]
+                if old_size:
+                    del self._cache[old_key]
+                    self._cache_size -= old_size
+
+    @contextmanager
+    def budget(self, buffer, sequence):
+        """
+        Count the sources read by the current thread, in the body
+        of a with statement, against buffer as source sequence. The
+        bytes are given back at the end.
+        """
+        self._local.budget = [buffer, sequence, 0]
+        try:
+            yield
+        finally:
+            buffer.unreserve(self._local.budget[2])
+            self._local.budget = None
+
+    def reserve(self, size, wait=True):
+        """
+        Count size bytes about to be read against the current
+        thread's budget, if it has one, waiting for room. If wait
+        is False return False at once when there is no room.
+        """
+        budget = getattr(self._local, 'budget', None)
+        if budget is None or size <= 0:
+            return True
+        if not budget[0].reserve(budget[1], size, wait=wait):
+            return False
+        budget[2] += size
+        return True
+
+    def take(self, size):
+        """
+        Count size bytes already read against the current thread's
+        budget, if it has one, whether or not there is room.
+        """
+        budget = getattr(self._local, 'budget', None)
+        if budget is None or size <= 0:
+            return
+        budget[0].take(size)
+        budget[2] += size
+
+    def span(self, name, url, **args):
+        """
+        Return a context manager timing the named step for url, if
+        there is a tracer, or doing nothing if not.
+        """
+        if self.tracer is None:
+            return _NO_SPAN
+        return self.tracer.span(name, url, **args)
+
+    def archive(self, url):
+        """
+        Return the _Archive at url, reading its index only the
+        first time it is asked for.
+        """
+        return self.cached(('archive', url), lambda: _Archive(url, self))
+
+    def clear(self):
+        """
+        Forget everything fetched so far, closing any archives.
+        """
+        with self._cache_lock:
+            cache = self._cache
+            self._cache = OrderedDict()
+            self._cache_size = 0
+        for result, _, _ in cache.values():
+            if isinstance(result, _Archive):
+                result.close()
+
+    def close(self):
+        """
+        Release the files the context holds open, at the end of an
+        import.
+        """
+        self.clear()
+
+
+class ImportTracer(object):
+    """
+    Record timed spans of an import, per thread, and write them out
+    as Trace Event Format JSON, as read by chrome://tracing, Perfetto
+    and speedscope. Spans on the same thread nest, so the output can
+    be viewed as a flame graph.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, url, **args):
+        """
+        Time the body of a with statement as a span called name.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, url, start, time.time(), **args)
+
+    def add(self, name, url, start, end, **args):
+        """
+        Record a span called name for url, from start to end.
+        """
+        args['url'] = url
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads[thread.ident] = len(self._threads) + 1
+                self.events.append({'name': 'thread_name', 'ph': 'M',
+                    'pid': self.pid, 'tid': self._threads[thread.ident],
+                    'args': {'name': thread.name}})
+            self.events.append({'name': name, 'cat': 'twimport', 'ph': 'X',
+                'ts': int((start - self.start) * 1000000),
+                'dur': int((end - start) * 1000000),
+                'pid': self.pid, 'tid': self._threads[thread.ident],
+                'args': args})
+
+    def write(self, path):
+        """
+        Write the spans recorded so far to the file at path.
+        """
+        with self._lock:
+            data = {'traceEvents': list(self.events),
+                    'displayTimeUnit': 'ms'}
+        handle = open(path, 'w')
+        try:
+            json.dump(data, handle)
+        finally:
+            handle.close()
+
+
+class _NoSpan(object):
+    """
+    A context manager which does nothing, for when there is no tracer.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class FetchScheduler(object):
+    """
+    Open remote URLs without overwhelming the hosts they are on.
+
+    At most host_limit requests to any one host are in progress at
+    once, a request holding its slot until its response has been
+    read or closed. If rate is set, each host also gets a token
+    bucket allowing rate requests per second, with bursts of up to
+    burst requests. Requests which time out, fail to connect or get
+    a status in RETRY_STATUS are tried again up to retries times,
+    waiting for the time given in a Retry-After header or else an
+    exponentially growing, jittered delay.
+    """
+
+    def __init__(self, host_limit=FETCH_HOST_LIMIT, rate=None, burst=None,
+            retries=FETCH_RETRIES, backoff=FETCH_BACKOFF,
+            timeout=FETCH_TIMEOUT):
+        self.host_limit = host_limit
+        self.rate = rate
+        self.burst = burst or host_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def open(self, url, method=None):
+        """
+        Open url, returning a file-like response. If method is
+        given, it is used instead of GET.
+        """
+        slot, bucket = self._host(urlparse(url)[1])
+        attempt = 0
+        while True:
+            if bucket:
+                bucket.take()
+            slot.acquire()
+            try:
+                handle = urlopen(_request(url, method), timeout=self.timeout)
+            except HTTPError as exc:
+                slot.release()
+                if exc.code not in RETRY_STATUS or attempt >= self.retries:
+                    raise
+                delay = _retry_after(exc.headers)
+                if delay is None:
+                    delay = self.delay(attempt)
+            except (URLError, IOError, OSError) as exc:
+                slot.release()
+                if attempt >= self.retries:
+                    raise
+                delay = self.delay(attempt)
+            else:
+                return _decoded(_SlotHandle(handle, slot))
+            attempt += 1
+            LOGGER.debug('retrying %s in %.2fs', url, delay)
+            time.sleep(delay)
+
+    def delay(self, attempt):
+        """
+        How long to wait before retrying a request that has failed
+        attempt + 1 times.
+        """
+        delay = min(self.backoff * (2 ** attempt), FETCH_MAX_DELAY)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _host(self, host):
+        """
+        Get the concurrency slots and token bucket for host.
+        """
+        with self._lock:
+            if host not in self._hosts:
+                bucket = None
+                if self.rate:
+                    bucket = _TokenBucket(self.rate, self.burst)
+                self._hosts[host] = (
+                        threading.BoundedSemaphore(self.host_limit), bucket)
+            return self._hosts[host]
+
+
+class _TokenBucket(object):
+    """
+    Allow rate events per second, in bursts of up to capacity.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Block until a token is available, then use it up.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                        self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class _SlotHandle(object):
+    """
+    Wrap a response so its host slot is given back once the
+    response has been read to the end or closed.
+    """
+
+    def __init__(self, handle, slot):
+        self.handle = handle
+        self.slot = slot
+        self._released = False
+        self._lock = threading.Lock()
+
+    def read(self, size=None):
+        """
+        Read from the response, releasing the slot at the end.
+        """
+        if size is None or size < 0:
+            # HTTPResponse only reads everything, undoing any chunked
+            # transfer encoding, when given no size.
+            data = self.handle.read()
+            self._release()
+            return data
+        data = self.handle.read(size)
+        if not data:
+            self._release()
+        return data
+
+    def close(self):
+        """
+        Close the response and release the slot.
+        """
+        try:
+            self.handle.close()
+        finally:
+            self._release()
+
+    def _release(self):
+        """
+        Give back the slot, only once.
+        """
+        with self._lock:
+            if not self._released:
+                self._released = True
+                self.slot.release()
+
+    def __getattr__(self, name):
+        """
+        Provide headers, geturl() and the rest from the response.
+        """
+        return getattr(self.handle, name)
+
+    def __del__(self):
+        """
+        Make sure an abandoned response does not keep its slot.
+        """
+        if not self._released:
+            self._release()
+
+
+class _Archive(object):
+    """
+    A zip or tar archive of tiddler files, with an index of its
+    members by path. Members are read, one at a time, straight from
+    the archive without extracting it.
+
+    A compressed tar can only be read quickly from start to end, so
+    its members are decompressed once, in order, into a temporary
+    spool file, from which they are then read in any order.
+    """
+
+    def __init__(self, url, context):
+        self.url = url
+        self._lock = threading.Lock()
+        path = _url_to_path(url)
+        if path:
+            self._file = open(path, 'rb')
+        else:
+            self._file = _spool_url(url, context)
+        self._zip = None
+        self._tar = None
+        self._spool = None
+        self._offsets = {}
+        self.names = []
+        self.members = {}
+        if url.endswith('.zip'):
+            self._zip = zipfile.ZipFile(self._file)
+            members = [(info.filename, info) for info
+                    in self._zip.infolist() if not info.filename.endswith('/')]
+        elif url.endswith('.tar'):
+            self._tar = tarfile.open(fileobj=self._file, mode='r:')
+            members = [(info.name, info) for info
+                    in self._tar.getmembers() if info.isfile()]
+        else:
+            members = self._spool_members()
+        for stored_name, info in members:
+            name = stored_name
+            while name.startswith('./'):
+                name = name[2:]
+            self.names.append(name)
+            self.members[name] = info
+            if stored_name in self._offsets:
+                self._offsets[name] = self._offsets.pop(stored_name)
+
+    def _spool_members(self):
+        """
+        Decompress the files in a compressed tar, in the order they
+        are stored, into the spool, noting where each one starts.
+        """
+        self._spool = tempfile.TemporaryFile()
+        members = []
+        archive = tarfile.open(fileobj=self._file, mode='r|*')
+        try:
+            for info in archive:
+                if not info.isfile():
+                    continue
+                self._offsets[info.name] = self._spool.tell()
+                shutil.copyfileobj(archive.extractfile(info), self._spool)
+                members.append((info.name, info))
+        finally:
+            archive.close()
+            self._file.close()
+        return members
+
+    def open(self, name):
+        """
+        Return a file-like handle on the member called name.
+        """
+        with self._lock:
+            try:
+                info = self.members[name]
+            except KeyError:
+                raise IOError('%s not in %s' % (name, self.url))
+            if self._zip:
+                data = self._zip.read(info)
+            elif self._tar:
+                data = self._tar.extractfile(info).read()
+            else:
+                self._spool.seek(self._offsets[name])
+                data = self._spool.read(info.size)
+        return _MemberHandle(data, '%s%s%s' % (self.url, ARCHIVE_SEPARATOR,
+            quote(name)))
+
+    def size(self, name):
+        """
+        Return the uncompressed size of the member called name.
+        """
+        try:
+            info = self.members[name]
+        except KeyError:
+            raise IOError('%s not in %s' % (name, self.url))
+        if self._zip:
+            return info.file_size
+        return info.size
+
+    def close(self):
+        """
+        Close the archive and any spool file.
+        """
+        with self._lock:
+            for fileobj in [self._zip, self._tar, self._spool, self._file]:
+                if fileobj is not None:
+                    fileobj.close()
+
+
+def _spool_url(url, context):
+    """
+    Copy the content at url into a temporary file, without holding
+    it all in memory, and return the file.
+    """
+    spool = tempfile.TemporaryFile()
+    with context.span('fetch', url):
+        handle = _open_url(url, context)
+        try:
+            shutil.copyfileobj(handle, spool)
+        finally:
+            handle.close()
+    spool.seek(0)
+    return spool
+
+
+class _MemberHandle(BytesIO):
+    """
+    The content of an archive member, or of a response which has
+    been read, with the headers and geturl() of a urlopen response.
+    If no headers are given they are guessed from the url.
+    """
+
+    def __init__(self, data, url, headers=None):
+        BytesIO.__init__(self, data)
+        self.url = url
+        if headers is None:
+            content_type = mimetypes.guess_type(url)[0]
+            headers = {
+                    'content-type': content_type or 'application/octet-stream',
+                    'content-length': str(len(data))}
+        self.headers = headers
+
+    def geturl(self):
+        """
+        The URL of the content.
+        """
+        return self.url
+
+
+class _DecodedHandle(object):
+    """
+    Wrap a gzip or deflate compressed response so that it is
+    decompressed, a chunk at a time, as it is read.
+    """
+
+    def __init__(self, handle, encoding):
+        self.handle = handle
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zlib.decompressobj()
+        self._buffer = b''
+        self._started = False
+        self._done = False
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes of decompressed data, or all of it.
+        """
+        if size is None or size < 0:
+            chunks = [self._buffer]
+            self._buffer = b''
+            while not self._done:
+                chunks.append(self._decompress_chunk())
+            return b''.join(chunks)
+        while len(self._buffer) < size and not self._done:
+            self._buffer += self._decompress_chunk()
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        """
+        Close the underlying response.
+        """
+        self.handle.close()
+
+    def _decompress_chunk(self):
+        """
+        Read and decompress the next chunk of the response.
+        """
+        chunk = self.handle.read(DECODE_CHUNK)
+        if not chunk:
+            self._done = True
+            return self._decompressor.flush()
+        try:
+            data = self._decompressor.decompress(chunk)
+        except zlib.error:
+            # Some servers send deflate data without the zlib header.
+            if self.encoding != 'deflate' or self._started:
+                raise
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self._decompressor.decompress(chunk)
+        self._started = True
+        return data
+
+    def __getattr__(self, name):
+        """
+        Provide headers, geturl() and the rest from the response.
+        """
+        return getattr(self.handle, name)
+
+
+class ImportPlan(object):
+    """
+    An estimate of what an import would involve, made without
+    saving anything: for each source the bag, url, tiddler titles,
+    size in bytes (None when unknown) and number of fetches.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.errors = []
+        self.extra_fetches = 0
+        self.overwrites = []
+        self.new = []
+
+    def add(self, bag_name, url, titles, size, fetches):
+        """
+        Record what importing url into bag_name would involve.
+        """
+        self.entries.append((bag_name, url, titles, size, fetches))
+
+    @property
+    def tiddler_count(self):
+        """
+        The number of tiddlers that would be saved.
+        """
+        return sum(len(entry[2]) for entry in self.entries)
+
+    @property
+    def byte_count(self):
+        """
+        The number of bytes that would be read, where known.
+        """
+        return sum(entry[3] for entry in self.entries if entry[3])
+
+    @property
+    def fetch_count(self):
+        """
+        The number of fetches that would be made, including recipes,
+        archive indexes and .meta probes.
+        """
+        return self.extra_fetches + sum(entry[4] for entry in self.entries)
+
+    def report(self):
+        """
+        Describe the plan, one line per source, then totals and
+        the tiddlers that would be overwritten.
+        """
+        lines = []
+        for bag_name, url, titles, size, fetches in self.entries:
+            lines.append('%s: %s: %d tiddlers, %s bytes, %d fetches' % (
+                bag_name, url, len(titles),
+                size is None and 'unknown' or size, fetches))
+        for url, message in self.errors:
+            lines.append('ERROR %s: %s' % (url, message))
+        unknown = len([entry for entry in self.entries if entry[3] is None])
+        lines.append('total: %d tiddlers (%d overwrite existing, %d new), '
+                '%d bytes%s, %d fetches' % (self.tiddler_count,
+                    len(self.overwrites), len(self.new), self.byte_count,
+                    unknown and ' (%d sources of unknown size)' % unknown
+                    or '', self.fetch_count))
+        if self.overwrites:
+            lines.append('overwrites:')
+            for bag_name, title in self.overwrites:
+                lines.append('    %s/%s' % (bag_name, title))
+        return '\n'.join(lines)
+
+
+class ImportBuffer(object):
+    """
+    A bounded buffer of parsed tiddlers between the workers which
+    fetch and parse sources and the thread which stores them.
+
+    Each source has a sequence number, and tiddlers are taken out
+    in sequence order, whatever order the workers finish in. A
+    worker putting a tiddler waits while the buffer holds max_items
+    tiddlers or the tiddler would take it over max_bytes. The one
+    exception is the source currently being stored, which may always
+    put a tiddler when none of its own are waiting, so the buffer
+    can never fill up with later sources while the store starves.
+
+    The bytes of sources being read may be reserved too, and count
+    towards max_bytes until they are given back.
+    """
+
+    def __init__(self, max_items=BUFFER_ITEMS, max_bytes=BUFFER_BYTES):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.current = 0
+        self.items = 0
+        self.bytes = 0
+        self.reserved = 0
+        self.peak_items = 0
+        self.peak_bytes = 0
+        self.aborted = False
+        self._tiddlers = {}
+        self._done = {}
+        self._condition = threading.Condition()
+
+    def put(self, sequence, tiddler):
+        """
+        Add a tiddler from source sequence, waiting for room if
+        need be. Return how long was spent waiting.
+        """
+        size = _tiddler_size(tiddler)
+        start = time.time()
+        with self._condition:
+            while not self.aborted and not (
+                    (self.items < self.max_items
+                        and self._held() + size <= self.max_bytes)
+                    or (sequence == self.current
+                        and not self._tiddlers.get(sequence))):
+                self._condition.wait()
+            if self.aborted:
+                raise ImportAborted('import aborted')
+            self._tiddlers.setdefault(sequence, deque()).append(
+                    (tiddler, size))
+            self.items += 1
+            self.bytes += size
+            self.peak_items = max(self.peak_items, self.items)
+            self.peak_bytes = max(self.peak_bytes, self._held())
+            self._condition.notify_all()
+        return time.time() - start
+
+    def reserve(self, sequence, size, wait=True):
+        """
+        Reserve size bytes for source sequence to read, waiting
+        for room, and return True. The source being stored need not
+        wait. If wait is False return False at once when there is no
+        room.
+        """
+        with self._condition:
+            while not self.aborted and not (
+                    self._held() + size <= self.max_bytes
+                    or sequence == self.current):
+                if not wait:
+                    return False
+                self._condition.wait()
+            if self.aborted:
+                raise ImportAborted('import aborted')
+            self.take(size)
+        return True
+
+    def take(self, size):
+        """
+        Count size bytes that have already been read, room or not.
+        """
+        with self._condition:
+            self.reserved += size
+            self.peak_bytes = max(self.peak_bytes, self._held())
+
+    def unreserve(self, size):
+        """
+        Give back size reserved bytes.
+        """
+        if not size:
+            return
+        with self._condition:
+            self.reserved -= size
+            self._condition.notify_all()
+
+    def _held(self):
+        """
+        The bytes of tiddlers waiting and of sources being read.
+        """
+        return self.bytes + self.reserved
+
+    def finish(self, sequence, fetch_time, error=None):
+        """
+        Mark source sequence as completely parsed, or failed
+        with error.
+        """
+        with self._condition:
+            self._done[sequence] = (fetch_time, error)
+            self._condition.notify_all()
+
+    def get(self):
+        """
+        Take the next tiddler of the current source, waiting for
+        it if need be. Return None when the current source is done.
+        """
+        with self._condition:
+            while True:
+                tiddlers = self._tiddlers.get(self.current)
+                if tiddlers:
+                    tiddler, size = tiddlers.popleft()
+                    self.items -= 1
+                    self.bytes -= size
+                    self._condition.notify_all()
+                    return tiddler
+                if self.current in self._done:
+                    return None
+                self._condition.wait()
+
+    def advance(self):
+        """
+        Move on to the next source, returning the fetch time and
+        error of the source just finished.
+        """
+        with self._condition:
+            self._tiddlers.pop(self.current, None)
+            result = self._done.pop(self.current)
+            self.current += 1
+            self._condition.notify_all()
+        return result
+
+    def abort(self):
+        """
+        Stop the import, waking any waiting workers.
+        """
+        with self._condition:
+            self.aborted = True
+            self._condition.notify_all()
+
+
+class ImportAborted(Exception):
+    """
+    The import was stopped before this source could be finished.
+    """
+    pass
+
+
+class ImportReport(object):
+    """
+    Counts and timings for an import run, one entry per source.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        self.entries = []
+        self.peak_items = 0
+        self.peak_bytes = 0
+
+    def add(self, bag_name, url, count, fetch_time, store_time):
+        """
+        Record that count tiddlers from url were saved to bag_name.
+        """
+        self.entries.append((bag_name, url, count, fetch_time, store_time))
+
+    def finish(self):
+        """
+        Mark the end of the run.
+        """
+        self.end = time.time()
+
+    @property
+    def tiddler_count(self):
+        """
+        The total number of tiddlers saved.
+        """
+        return sum(entry[2] for entry in self.entries)
+
+    def summary(self):
+        """
+        Describe the whole run in one line.
+        """
+        end = self.end or time.time()
+        bags = set(entry[0] for entry in self.entries)
+        return ('imported %d tiddlers from %d sources into %d bags in '
+                '%.2fs (fetch and parse %.2fs, store %.2fs)' % (
+                    self.tiddler_count, len(self.entries), len(bags),
+                    end - self.start,
+                    sum(entry[3] for entry in self.entries),
+                    sum(entry[4] for entry in self.entries)))
+
+
+def import_list(bag_name, urls, store, processes=IMPORT_PROCESSES,
+        context=None, max_items=BUFFER_ITEMS, max_bytes=BUFFER_BYTES,
+        trace=None, profile=None):
     """
     Import a list of URIs into the named bag.
     """
-    for url in urls:
-        import_one(bag_name, url, store)
+    return import_manifest([(bag_name, urls)], store, processes=processes,
+            context=context, max_items=max_items, max_bytes=max_bytes,
+            trace=trace, profile=profile)
+
+
+def import_manifest(manifest, store, processes=IMPORT_PROCESSES,
+        context=None, progress=None, max_items=BUFFER_ITEMS,
+        max_bytes=BUFFER_BYTES, trace=None, profile=None):
+    """
+    Import the URIs in manifest, a list of (bag name, list of URIs)
+    pairs, sharing one pool of worker threads and one ImportContext.
+
+    Recipes are expanded first. Then each source is fetched and
+    parsed by the pool while the calling thread saves the results
+    in manifest order, so that later sources override earlier ones.
+    Between the two stages tiddlers wait in an ImportBuffer holding
+    at most about max_items tiddlers and max_bytes of text.
+
+    If provided, progress is called with a line describing each
+    source once it is saved. Returns an ImportReport.
+
+    If trace is a path, spans for each step of the import are
+    written there as Trace Event Format JSON. If profile is a path,
+    the import is run under cProfile, in every thread where Python
+    allows it, and the combined pstats data is written there.
+    """
+    owned = context is None
+    if owned:
+        context = ImportContext(store.environ)
+    if trace and context.tracer is None:
+        context.tracer = ImportTracer()
+    profiles = []
+    if profile:
+        profiles.append(cProfile.Profile())
+        profiles[0].enable()
+    try:
+        return _import_manifest(manifest, store, processes, context,
+                progress, max_items, max_bytes, profiles)
+    finally:
+        if profile:
+            profiles[0].disable()
+            stats = pstats.Stats(profiles[0])
+            for worker_profile in profiles[1:]:
+                stats.add(worker_profile)
+            stats.dump_stats(profile)
+        if trace:
+            context.tracer.write(trace)
+        if owned:
+            context.close()
+
+
+def _import_manifest(manifest, store, processes, context, progress,
+        max_items, max_bytes, profiles):
+    """
+    Do the work of import_manifest. If profiles is not empty, each
+    job is profiled and its profile added to profiles.
+    """
+    report = ImportReport()
+    jobs = _manifest_jobs(manifest, context)
+    buffer = ImportBuffer(max_items=max_items, max_bytes=max_bytes)
+
+    def fetch(numbered_job):
+        """
+        Fetch and parse the tiddlers of one job into the buffer,
+        in a worker.
+        """
+        sequence, (bag_name, url, fragments, in_recipe) = numbered_job
+        if buffer.aborted:
+            return
+        job_profile = None
+        if profiles:
+            job_profile = cProfile.Profile()
+            try:
+                job_profile.enable()
+            except ValueError:
+                # only one profiler may be active at once on Python 3.12+
+                job_profile = None
+        start = time.time()
+        waited = 0
+        error = None
+        try:
+            with context.span('source', url, bag=bag_name):
+                with context.budget(buffer, sequence):
+                    if in_recipe:
+                        tiddlers = [url_to_tiddler(url, context=context)]
+                    else:
+                        tiddlers = _source_tiddlers(url, context, fragments)
+                    for tiddler in tiddlers:
+                        waited += buffer.put(sequence, tiddler)
+        except ImportAborted:
+            return
+        except Exception as exc:
+            error = exc
+        finally:
+            if job_profile:
+                job_profile.disable()
+                profiles.append(job_profile)
+        buffer.finish(sequence, time.time() - start - waited, error)
+
+    pool = ThreadPool(processes)
+    try:
+        pool.map_async(fetch, list(enumerate(jobs)), chunksize=1)
+        for index, (bag_name, url, fragments, _) in enumerate(jobs):
+            count = 0
+            store_time = 0
+            while True:
+                tiddler = buffer.get()
+                if tiddler is None:
+                    break
+                start = time.time()
+                with context.span('store', url, title=tiddler.title):
+                    count += _store_tiddlers(bag_name, [tiddler], fragments,
+                            store)
+                store_time += time.time() - start
+            fetch_time, error = buffer.advance()
+            if error:
+                raise error
+            report.add(bag_name, url, count, fetch_time, store_time)
+            if progress:
+                progress('[%d/%d] %s: %s (%d tiddlers)' % (index + 1,
+                    len(jobs), bag_name, url, count))
+    finally:
+        buffer.abort()
+        pool.close()
+        pool.join()
+    report.peak_items = buffer.peak_items
+    report.peak_bytes = buffer.peak_bytes
+    report.finish()
+    return report
+
+
+def plan_list(bag_name, urls, store, context=None):
+    """
+    Plan the import of a list of URIs into the named bag.
+    """
+    return plan_manifest([(bag_name, urls)], store, context=context)
+
+
+def plan_manifest(manifest, store, context=None):
+    """
+    Work out what importing manifest would involve, without
+    saving anything, and return an ImportPlan.
+
+    Recipes and archive indexes are read, tiddler files are only
+    sized with a stat or HEAD request and wikis and JSON bundles
+    are read but only scanned for titles. The titles are compared
+    with those already in each bag.
+    """
+    owned = context is None
+    if owned:
+        context = ImportContext(store.environ)
+    try:
+        return _plan_manifest(manifest, store, context)
+    finally:
+        if owned:
+            context.close()
 
 
-def import_one(bag_name, url, store):
+def _plan_manifest(manifest, store, context):
+    """
+    Do the work of plan_manifest.
+    """
+    plan = ImportPlan()
+    recipes = []
+    jobs = []
+    for bag_name, urls in manifest:
+        for url in urls:
+            try:
+                jobs.extend(_manifest_jobs([(bag_name, [url])], context,
+                    recipes=recipes))
+            except (HTTPError, URLError, IOError, OSError,
+                    ValueError) as exc:
+                plan.errors.append((url, '%s' % exc))
+    archives = set(member[0] for member in
+            (_archive_member(job[1]) for job in jobs) if member)
+    plan.extra_fetches = len(recipes) + len(archives)
+
+    for bag_name, url, fragments, in_recipe in jobs:
+        try:
+            if in_recipe or not (_is_wiki(url) or _is_json(url)):
+                titles = [_guess_title(url)]
+                size, fetches = _probe_size(url, context)
+            else:
+                url, content = _read_url_handle(url, context)
+                titles = _source_titles(url,
+                        content.decode('utf-8', 'replace'))
+                size = len(content)
+                fetches = 1
+        except (HTTPError, URLError, IOError, OSError, ValueError) as exc:
+            plan.errors.append((url, '%s' % exc))
+            continue
+        if fragments:
+            titles = [title for title in titles if title in fragments]
+        plan.add(bag_name, url, titles, size, fetches)
+
+    seen = set()
+    existing = {}
+    for bag_name, _, titles, _, _ in plan.entries:
+        if bag_name not in existing:
+            existing[bag_name] = _bag_titles(store, bag_name)
+        for title in titles:
+            if (bag_name, title) in seen:
+                continue
+            seen.add((bag_name, title))
+            if title in existing[bag_name]:
+                plan.overwrites.append((bag_name, title))
+            else:
+                plan.new.append((bag_name, title))
+    return plan
+
+
+def manifest_to_list(url, context=None):
+    """
+    Read a manifest of "bag: URI" lines into a list of (bag name,
+    list of URIs) pairs, suitable for import_manifest. The URIs for
+    a bag keep the order in which they are listed.
+    """
+    context = _get_context(context)
+    url, content = context.cached(url,
+            lambda: _read_url_handle(url, context))
+    bags = []
+    urls = {}
+    for line in content.decode('utf-8', 'replace').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            bag_name, target = line.split(':', 1)
+        except ValueError:
+            raise ValueError('bad manifest line: %s' % line)
+        bag_name = bag_name.strip()
+        target, hash_mark, fragment = target.strip().partition('#')
+        target = _resolve_target(target, url) + hash_mark + fragment
+        if bag_name not in urls:
+            bags.append(bag_name)
+            urls[bag_name] = []
+        urls[bag_name].append(target)
+    return [(bag_name, urls[bag_name]) for bag_name in bags]
+
+
+def import_one(bag_name, url, store, context=None):
     """
     Import one URI into bag. If the URI has a #fragment it
     will be processed as a TiddlyWiki permaview fragment and
     used to limit the tiddlers that get saved.
     """
+    owned = context is None
+    context = _get_context(context)
     fragments = []
     if '#' in url:
         url, fragment = url.split('#', 1)
         fragments = _parse_fragment(fragment)
-    if url.endswith('.recipe'):
-        tiddlers = [url_to_tiddler(tiddler_url) for
-                tiddler_url in recipe_to_urls(url)]
-    elif url.endswith('.wiki') or url.endswith('.html'):
-        tiddlers = wiki_to_tiddlers(url)
-    else:  # we have a tiddler of some form
-        tiddlers = [url_to_tiddler(url)]
+    try:
+        if _is_recipe(url) or _is_archive(url):
+            tiddlers = [url_to_tiddler(tiddler_url, context=context) for
+                    tiddler_url in _expand_source(url, context)]
+        else:
+            tiddlers = _source_tiddlers(url, context, fragments)
 
-    for tiddler in tiddlers:
-        if fragments and tiddler.title not in fragments:
-            continue
-        tiddler.bag = bag_name
-        store.put(tiddler)
+        _store_tiddlers(bag_name, tiddlers, fragments, store)
+    finally:
+        if owned:
+            context.close()
 
 
-def recipe_to_urls(url):
+class ImportWatcher(object):
+    """
+    Watch the local files behind a list of URIs and import again
+    the tiddlers that come from any file that changes.
+
+    scan() maps each local file, including .meta files and the
+    nested recipes found by _expand_recipe, to the imports which
+    depend on it. check() compares the current state of those files
+    with the state at the last scan and repeats only the affected
+    imports. A tiddler file or its .meta causes just that tiddler
+    to be imported again. A changed recipe or wiki is imported whole
+    and the map is rebuilt, as its list of tiddlers may have changed.
+    """
+
+    def __init__(self, bag_name, urls, store, context=None):
+        self.bag_name = bag_name
+        self.urls = urls
+        self.store = store
+        self.context = _get_context(context)
+        self.targets = {}
+        self.stats = {}
+        self.scan()
+
+    def scan(self):
+        """
+        Build the map from local file paths to import targets.
+        """
+        self.targets = {}
+        self.context.clear()
+        for url in self.urls:
+            source = url
+            fragments = ()
+            if '#' in url:
+                source, fragment = url.split('#', 1)
+                fragments = tuple(_parse_fragment(fragment))
+            if _is_recipe(source):
+                recipes = []
+                tiddler_urls = recipe_to_urls(source, recipes=recipes,
+                        context=self.context)
+                for recipe_url in recipes:
+                    self._watch(recipe_url, ('import', url, fragments))
+                for tiddler_url in tiddler_urls:
+                    self._watch_tiddler(tiddler_url, fragments)
+            elif (_is_wiki(source) or _is_json(source)
+                    or _is_archive(source)):
+                self._watch(source, ('import', url, fragments))
+            else:
+                self._watch_tiddler(source, fragments)
+        self.stats = dict((path, _stat_path(path)) for path in self.targets)
+
+    def check(self):
+        """
+        Import again whatever depends on files which have changed
+        since the last check. Return the list of changed paths.
+        """
+        changed = [path for path in sorted(self.targets)
+                if _stat_path(path) != self.stats[path]]
+        if changed:
+            self.context.clear()
+        targets = []
+        for path in changed:
+            self.stats[path] = _stat_path(path)
+            for target in self.targets[path]:
+                if target not in targets:
+                    targets.append(target)
+
+        rescan = False
+        for kind, url, fragments in targets:
+            try:
+                if kind == 'import':
+                    rescan = True
+                    import_one(self.bag_name, url, self.store,
+                            context=self.context)
+                else:
+                    tiddler = url_to_tiddler(url, context=self.context)
+                    if fragments and tiddler.title not in fragments:
+                        continue
+                    tiddler.bag = self.bag_name
+                    self.store.put(tiddler)
+            except Exception as exc:
+                LOGGER.warning('unable to reimport %s: %s', url, exc)
+        if rescan:
+            self.scan()
+        return changed
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """
+        Poll for changes forever, every interval seconds, yielding
+        each changed path after the related imports have happened.
+        """
+        while True:
+            time.sleep(interval)
+            for path in self.check():
+                yield path
+
+    def _watch_tiddler(self, url, fragments):
+        """
+        Watch the file of a single tiddler and its .meta file.
+        """
+        path = url
+        if ' ' in url:
+            uri, mime_type = url.split(' ', 1)
+            if '/' in mime_type:
+                path = uri
+        self._watch(path, ('tiddler', url, fragments))
+        self._watch('%s.meta' % _uncompressed_url(path),
+                ('tiddler', url, fragments))
+
+    def _watch(self, url, target):
+        """
+        Associate target with the local file at url. Remote
+        URLs are not watched.
+        """
+        path = _url_to_path(url)
+        if path:
+            targets = self.targets.setdefault(path, [])
+            if target not in targets:
+                targets.append(target)
+
+
+def recipe_to_urls(url, recipes=None, context=None):
     """
     Provided a url or path to a Cook-style recipe, explode the recipe to
     a list of URLs of tiddlers (of various types).
+
+    If recipes is a list, the URL of this recipe and of every recipe
+    it includes is appended to it.
+    """
+    context = _get_context(context)
+    with context.span('recipe', url):
+        url, content = context.cached(url,
+                lambda: _read_url_handle(url, context))
+    if recipes is not None:
+        recipes.append(url)
+    return _expand_recipe(content.decode('utf-8', 'replace'), url,
+            recipes=recipes, context=context)
+
+
+def archive_to_urls(url, context=None):
     """
-    url, handle = get_url_handle(url)
-    return _expand_recipe(handle.read().decode('utf-8', 'replace'), url)
+    Provided a url or path to a zip or tar archive, list the URLs
+    of the tiddler files inside it, skipping .meta files and recipes.
+    """
+    context = _get_context(context)
+    url = _archive_url(url)
+    archive = context.archive(url)
+    return ['%s%s%s' % (url, ARCHIVE_SEPARATOR, quote(name)) for name
+            in archive.names if not name.endswith('.meta')
+            and not _is_recipe(name)]
 
 
-def url_to_tiddler(url):
+def url_to_tiddler(url, context=None):
     """
     Given a url to a tiddlers of some form,
     return a Tiddler object.
     """
+    context = _get_context(context)
     mime_type = None
     if ' ' in url:
         uri, mime_type = url.split(' ', 1)
         if '/' in mime_type:
             url = uri
-    url, handle = get_url_handle(url)
-
-    if url.endswith('.js') and not mime_type:
-        tiddler = from_plugin(url, handle)
-    elif url.endswith('.tid'):
-        tiddler = from_tid(url, handle)
-    elif url.endswith('.tiddler'):
-        tiddler = from_tiddler(handle)
-    else:
-        # binary tiddler
-        tiddler = from_special(url, handle, mime=mime_type)
+    url, handle = get_url_handle(url, context=context)
+
+    with context.span('parse', url):
+        if url.endswith('.js') and not mime_type:
+            tiddler = from_plugin(url, handle, context=context)
+        elif url.endswith('.tid'):
+            tiddler = from_tid(url, handle, context=context)
+        elif url.endswith('.tiddler'):
+            tiddler = from_tiddler(handle, context=context)
+        else:
+            # binary tiddler
+            tiddler = from_special(url, handle, mime=mime_type,
+                    context=context)
     return tiddler
 
 
-def wiki_to_tiddlers(url):
+def wiki_to_tiddlers(url, context=None, titles=None):
+    """
+    Retrieve a .wiki or .html as a TiddlyWiki and return a list of
+    the contained tiddlers.
+
+    If titles are given and the wiki is a local TiddlyWiki 2.x
+    file, only the tiddlers with those titles are read, found
+    using the wiki's index. Otherwise all tiddlers are returned.
+    """
+    return list(_wiki_tiddlers(url, _get_context(context), titles))
+
+
+def wiki_index(path, index_dir=None):
+    """
+    Return a dict mapping the title of each tiddler in the storeArea
+    of the TiddlyWiki 2.x file at path to the byte offsets of the
+    start and end of its div, or None if the file has no storeArea.
+
+    If index_dir is given, the index is kept in a file there and
+    used for as long as the wiki's size and modification time, or
+    failing that its SHA-1 digest, are unchanged. Otherwise it is
+    built again.
+    """
+    if index_dir is None:
+        return _index_store_area(_read_file(path))
+    index_path = _index_path(path, index_dir)
+    stat = os.stat(path)
+    try:
+        handle = open(index_path)
+        try:
+            saved = json.load(handle)
+        finally:
+            handle.close()
+    except (IOError, OSError, ValueError):
+        saved = {}
+
+    if saved.get('size') == stat.st_size:
+        if saved.get('mtime') == stat.st_mtime:
+            return saved['tiddlers']
+        content = _read_file(path)
+        if saved.get('digest') == hashlib.sha1(content).hexdigest():
+            saved['mtime'] = stat.st_mtime
+            _write_index(index_path, saved)
+            return saved['tiddlers']
+    else:
+        content = _read_file(path)
+
+    saved = {'size': stat.st_size, 'mtime': stat.st_mtime,
+            'digest': hashlib.sha1(content).hexdigest(),
+            'tiddlers': _index_store_area(content)}
+    _write_index(index_path, saved)
+    return saved['tiddlers']
+
+
+def json_to_tiddlers(url, context=None):
     """
-    Retrieve a .wiki or .html as a TiddlyWiki and extract the
-    contained tiddlers.
+    Retrieve a .json file containing a list of TiddlyWiki 5 style
+    tiddlers and return a list of those tiddlers. A .json file which
+    is not such a bundle is imported as a single tiddler, as by
+    url_to_tiddler.
     """
-    url, handle = get_url_handle(url)
-    return wiki_string_to_tiddlers(handle.read().decode('utf-8', 'replace'))
+    return list(_json_tiddlers(url, _get_context(context)))
 
 
-def wiki_string_to_tiddlers(content):
+def _json_tiddlers(url, context):
+    """
+    Generate the tiddlers in the .json file at url.
+    """
+    url, handle = get_url_handle(url, context=context)
+    data = handle.read()
+    content = data.decode('utf-8', 'replace')
+    if not _is_json_bundle(content):
+        with context.span('parse', url):
+            tiddler = from_special(url, _MemberHandle(data, url,
+                handle.headers), context=context)
+        yield tiddler
+        return
+    for tiddler in _traced(context, 'parse', url,
+            json_string_to_tiddlers(content)):
+        yield tiddler
+
+
+def json_string_to_tiddlers(content):
     """
-    Turn a string that is a TiddlyWiki into individual tiddlers.
+    Generate tiddlers from a string that is a JSON list of
+    TiddlyWiki 5 style tiddlers, or a single such tiddler.
     """
-    parser = HTMLParser(tree=treebuilders.getTreeBuilder('dom'))
-    doc = parser.parse(content)
+    start = WHITESPACE.match(content).end()
+    if content.startswith('{', start):
+        items = [json.loads(content)]
+    else:
+        items = _json_list_items(content, start, len(content))
+    for data in items:
+        if not isinstance(data, dict):
+            raise ValueError('JSON bundle item is not a tiddler')
+        if data.get('title'):
+            yield _get_tiddler_from_json(data)
+
+
+def _is_json_bundle(content):
+    """
+    Does content look like TiddlyWiki 5 JSON: a tiddler object with
+    a title or a list whose first item is one?
+    """
+    start = WHITESPACE.match(content).end()
+    try:
+        if content.startswith('{', start):
+            item = json.JSONDecoder().raw_decode(content, start)[0]
+        elif content.startswith('[', start):
+            item = next(_json_list_items(content, start, len(content)))
+        else:
+            return False
+    except (ValueError, StopIteration):
+        return False
+    return isinstance(item, dict) and bool(item.get('title'))
+
+
+def wiki_string_to_tiddlers(content, context=None):
+    """
+    Turn a string that is a TiddlyWiki into a list of individual
+    tiddlers.
+    """
+    return list(_wiki_string_tiddlers(content, _get_context(context)))
+
+
+def _wiki_tiddlers(url, context, titles=None):
+    """
+    Generate the tiddlers in the TiddlyWiki at url, or only those
+    with the given titles if it is a local TiddlyWiki 2.x file
+    which can be indexed.
+    """
+    if titles:
+        path = _local_wiki_path(url)
+        if path:
+            with context.span('index', url):
+                index = context.cached(('index', path),
+                        lambda: wiki_index(path, context.index_dir))
+            if index is not None:
+                for tiddler in _indexed_tiddlers(path, index, titles,
+                        context):
+                    yield tiddler
+                return
+    url, handle = get_url_handle(url, context=context)
+    content = handle.read().decode('utf-8', 'replace')
+    for tiddler in _traced(context, 'parse', url,
+            _wiki_string_tiddlers(content, context)):
+        yield tiddler
+
+
+def _wiki_string_tiddlers(content, context):
+    """
+    Generate the tiddlers in a string that is a TiddlyWiki.
+
+    A TiddlyWiki 5 tiddler store is located by searching the string
+    for its <script> tag and its tiddlers are generated one at a time
+    from the JSON, without parsing the HTML. The divs in a TiddlyWiki
+    2.x storeArea are likewise found by scanning the string and
+    parsed one at a time.
+    """
+    if TW5_STORE.search(content):
+        return _tw5_store_tiddlers(content)
+    return _tw2_store_tiddlers(content, context)
+
+
+def _tw2_store_tiddlers(content, context):
+    """
+    Generate the tiddlers in the storeArea of a TiddlyWiki 2.x,
+    parsing one div at a time, or the whole document if the
+    storeArea cannot be scanned.
+    """
+    divs = _store_area_divs(content)
+    if divs is None:
+        for tiddler in _tw2_document_tiddlers(content, context):
+            yield tiddler
+        return
+    for start, end in divs:
+        yield _div_to_tiddler(content[start:end], context)
+
+
+def _tw2_document_tiddlers(content, context):
+    """
+    Parse the whole of a TiddlyWiki 2.x document and return the
+    tiddlers in its storeArea.
+    """
+    doc = context.parse_html(content)
     # minidom will not provide working getElementById without
     # first having a valid document, which means some very specific
     # doctype hooey. So we traverse
@@ -182,10 +1811,107 @@ def wiki_string_to_tiddlers(content):
             tiddlers.append(_get_tiddler_from_div(tiddler_div))
         return tiddlers
     else:
-        raise ValueError('content not a tiddlywiki 2.x')
+        raise ValueError('content not a tiddlywiki 2.x or 5')
+
+
+def _store_area_divs(content):
+    """
+    Find the start and end offsets of each tiddler div in the
+    storeArea of content, a TiddlyWiki 2.x. Return None if there is
+    no storeArea or it holds anything other than a run of divs.
+    """
+    start = content.find(STORE_AREA)
+    if start == -1:
+        return None
+    position = content.find('>', start) + 1
+    divs = []
+    while True:
+        match = STORE_AREA_DIV.match(content, position)
+        if not match:
+            return None
+        if match.group(1):
+            return divs
+        start = match.end() - len('<div')
+        end = content.find('</div>', match.end())
+        if end == -1:
+            return None
+        position = end + len('</div>')
+        divs.append((start, position))
+
+
+def _div_to_tiddler(content, context):
+    """
+    Create a Tiddler from a string holding a single tiddler div.
+    """
+    dom = context.parse_html(content)
+    return _get_tiddler_from_div(dom.getElementsByTagName('div')[0])
+
+
+def _traced(context, name, url, tiddlers):
+    """
+    Generate tiddlers, timing the making of each one as a span
+    called name, so time spent by the consumer is not counted.
+    """
+    tiddlers = iter(tiddlers)
+    while True:
+        with context.span(name, url):
+            try:
+                tiddler = next(tiddlers)
+            except StopIteration:
+                return
+        yield tiddler
+
+
+def _tw5_store_tiddlers(content):
+    """
+    Generate the tiddlers in each TiddlyWiki 5 tiddler store
+    <script> block in content.
+    """
+    for data in _tw5_store_items(content):
+        if data.get('title'):
+            yield _get_tiddler_from_json(data)
+
 
+def _tw5_store_items(content):
+    """
+    Generate the dicts of fields in each TiddlyWiki 5 tiddler store
+    <script> block in content.
+    """
+    position = 0
+    while True:
+        match = TW5_STORE.search(content, position)
+        if not match:
+            break
+        start = match.end()
+        end = content.find('</script>', start)
+        if end == -1:
+            raise ValueError('unterminated tiddler store')
+        for data in _json_list_items(content, start, end):
+            yield data
+        position = end
 
-def from_plugin(uri, handle):
+
+def _json_list_items(content, position, end):
+    """
+    Generate the items of the JSON list found in content between
+    position and end, decoding one item at a time.
+    """
+    decoder = json.JSONDecoder()
+    position = WHITESPACE.match(content, position).end()
+    if position == end:
+        return
+    if not content.startswith('[', position):
+        raise ValueError('tiddler store is not a JSON list')
+    position = WHITESPACE.match(content, position + 1).end()
+    while position < end and content[position] != ']':
+        item, position = decoder.raw_decode(content, position)
+        yield item
+        position = WHITESPACE.match(content, position).end()
+        if content.startswith(',', position):
+            position = WHITESPACE.match(content, position + 1).end()
+
+
+def from_plugin(uri, handle, context=None):
     """
     Generate a tiddler from a JavaScript (and accompanying meta) file
     If there is no .meta file, title and tags assume default values.
@@ -193,9 +1919,13 @@ def from_plugin(uri, handle):
     default_title = _get_title_from_uri(uri)
     default_tags = 'systemConfig'
 
+    # Read the plugin first so a remote handle gives back its host
+    # slot before the .meta file is fetched from the same host.
+    plugin_content = handle.read().decode('utf-8', 'replace')
+
     meta_uri = '%s.meta' % uri
     try:
-        meta_content = _get_url(meta_uri)
+        meta_content = _get_url(meta_uri, context=context)
     except (HTTPError, URLError, IOError, OSError):
         meta_content = 'title: %s\ntags: %s\n' % (default_title, default_tags)
     try:
@@ -208,13 +1938,12 @@ def from_plugin(uri, handle):
             if not line.startswith('title:')).rstrip()
     tiddler_meta = 'type: text/javascript\n%s' % tiddler_meta
 
-    plugin_content = handle.read().decode('utf-8', 'replace')
     tiddler_text = '%s\n\n%s' % (tiddler_meta, plugin_content)
 
-    return _from_text(title, tiddler_text)
+    return _from_text(title, tiddler_text, context=context)
 
 
-def from_special(uri, handle, mime=None):
+def from_special(uri, handle, mime=None, context=None):
     """
     Import a binary or pseudo binary tiddler. If a mime is provided,
     set the type of the tiddler to that. Otherwise use the type determined
@@ -232,8 +1961,8 @@ def from_special(uri, handle, mime=None):
 
     meta_uri = '%s.meta' % uri
     try:
-        meta_content = _get_url(meta_uri)
-        tiddler = _from_text(title, meta_content + '\n\n')
+        meta_content = _get_url(meta_uri, context=context)
+        tiddler = _from_text(title, meta_content + '\n\n', context=context)
     except (HTTPError, URLError, IOError, OSError):
         tiddler = Tiddler(title)
 
@@ -248,23 +1977,23 @@ def from_special(uri, handle, mime=None):
     return tiddler
 
 
-def from_tid(uri, handle):
+def from_tid(uri, handle, context=None):
     """
     generates a tiddler from a TiddlyWeb-style .tid file
     """
     title = _get_title_from_uri(uri)
-    return _from_text(title, handle.read().decode('utf-8', 'replace'))
+    return _from_text(title, handle.read().decode('utf-8', 'replace'),
+            context=context)
 
 
-def from_tiddler(handle):
+def from_tiddler(handle, context=None):
     """
     generates a tiddler from a Cook-style .tiddler file
     """
     content = handle.read().decode('utf-8', 'replace')
     content = _escape_brackets(content)
 
-    parser = HTMLParser(tree=treebuilders.getTreeBuilder('dom'))
-    dom = parser.parse(content)
+    dom = _get_context(context).parse_html(content)
     node = dom.getElementsByTagName('div')[0]
 
     return _get_tiddler_from_div(node)
@@ -306,7 +2035,7 @@ def _strip_extension(title):
         return title
 
 
-def _expand_recipe(content, url=''):
+def _expand_recipe(content, url='', recipes=None, context=None):
     """
     Expand a recipe into a list of usable URLs.
 
@@ -321,43 +2050,513 @@ def _expand_recipe(content, url=''):
             continue  # blank line in recipe
         if target_type in ACCEPTED_RECIPE_TYPES:
             target = target.lstrip().rstrip()
-            # translate well-known variables
-            for name in COOK_VARIABLES:
-                target = target.replace('$%s' % name, COOK_VARIABLES[name])
-            # Check to see if the target is a URL (has a scheme)
-            # if not we want to join it to the current url before
-            # carrying on.
-            scheme, _ = splittype(target)
-            if not scheme:
-                if not '%' in target:
-                    target = quote(target)
-                target = urljoin(url, target)
+            target = _resolve_target(target, url)
             if target_type == 'recipe':
-                urls.extend(recipe_to_urls(target))
+                urls.extend(recipe_to_urls(target, recipes=recipes,
+                    context=context))
             else:
                 urls.append(target)
     return urls
 
 
-def _get_url(url):
+def _resolve_target(target, url):
+    """
+    Translate well-known variables in target and, if it is not
+    already a URL, join it to the url of the file it came from.
+    """
+    for name in COOK_VARIABLES:
+        target = target.replace('$%s' % name, COOK_VARIABLES[name])
+    # Check to see if the target is a URL (has a scheme)
+    # if not we want to join it to the current url before
+    # carrying on.
+    scheme, _ = splittype(target)
+    if not scheme:
+        if not '%' in target:
+            # quote each side of an archive member's separator
+            target = ARCHIVE_SEPARATOR.join(quote(part) for part
+                    in target.split(ARCHIVE_SEPARATOR, 1))
+        target = urljoin(url, target)
+    return target
+
+
+def _manifest_jobs(manifest, context, recipes=None):
+    """
+    Turn a manifest into an ordered list of (bag name, URI, fragments,
+    in recipe) jobs, each of which is a single tiddler, a wiki or
+    a JSON bundle. Recipes are expanded to their tiddlers, which share
+    the recipe's fragments and are always imported as single tiddlers.
+
+    If recipes is a list, the URL of every recipe read is appended.
+    """
+    jobs = []
+    for bag_name, urls in manifest:
+        for url in urls:
+            fragments = []
+            if '#' in url:
+                url, fragment = url.split('#', 1)
+                fragments = _parse_fragment(fragment)
+            if _is_recipe(url) or _is_archive(url):
+                for tiddler_url in _expand_source(url, context,
+                        recipes=recipes):
+                    jobs.append((bag_name, tiddler_url, fragments, True))
+            else:
+                jobs.append((bag_name, url, fragments, False))
+    return jobs
+
+
+def _expand_source(url, context, recipes=None):
+    """
+    Expand a recipe or an archive to the URLs of its tiddlers.
+    """
+    if _is_archive(url):
+        return archive_to_urls(url, context=context)
+    return recipe_to_urls(url, recipes=recipes, context=context)
+
+
+def _guess_title(url):
+    """
+    Guess the title of the tiddler at url from the url alone.
+    """
+    if ' ' in url:
+        uri, mime_type = url.split(' ', 1)
+        if '/' in mime_type:
+            url = uri
+    return _get_title_from_uri(_uncompressed_url(url))
+
+
+def _probe_size(url, context):
+    """
+    Find the size of the tiddler file at url without reading it,
+    returning the size (or None) and the number of fetches the
+    import of it would make.
+    """
+    mime_type = None
+    if ' ' in url:
+        uri, mime_type = url.split(' ', 1)
+        if '/' in mime_type:
+            url = uri
+    # .js without a type and other non-tiddler files look for a .meta
+    plain = _uncompressed_url(url)
+    fetches = 1
+    if not (plain.endswith('.tid') or plain.endswith('.tiddler') or
+            (plain.endswith('.js') and mime_type)):
+        fetches = 2
+
+    member = _archive_member(url)
+    if member:
+        return context.archive(member[0]).size(member[1]), 0
+    path = _url_to_path(url)
+    if path:
+        return os.stat(path).st_size, fetches
+    handle = context.scheduler.open(url, method='HEAD')
+    try:
+        length = handle.headers.get('content-length')
+    finally:
+        handle.close()
+    if length:
+        return int(length), fetches
+    return None, fetches
+
+
+def _source_titles(url, content):
+    """
+    List the titles of the tiddlers in a wiki or JSON bundle,
+    without making tiddlers.
+    """
+    if _is_json(url):
+        if not _is_json_bundle(content):
+            return [_get_title_from_uri(url)]
+        start = WHITESPACE.match(content).end()
+        if content.startswith('{', start):
+            items = [json.loads(content)]
+        else:
+            items = _json_list_items(content, start, len(content))
+        return [item['title'] for item in items if item.get('title')]
+    if TW5_STORE.search(content):
+        return [item['title'] for item in _tw5_store_items(content)
+                if item.get('title')]
+    divs = _store_area_divs(content)
+    if divs is None:
+        return [tiddler.title for tiddler
+                in _tw2_document_tiddlers(content, ImportContext())]
+    return [_html_decode(match.group(1)) for match in
+            (TIDDLER_DIV.match(content, start) for start, _ in divs)
+            if match]
+
+
+def _bag_titles(store, bag_name):
+    """
+    The titles of the tiddlers already in the named bag.
+    """
+    try:
+        bag = store.get(Bag(bag_name))
+    except NoBagError:
+        return set()
+    return set(tiddler.title for tiddler in store.list_bag_tiddlers(bag))
+
+
+def _source_tiddlers(url, context, fragments=None):
+    """
+    Return the tiddlers found at a URI which is not a recipe. If
+    there are fragments a wiki may return only those tiddlers.
+    """
+    if _is_wiki(url):
+        return _wiki_tiddlers(url, context, fragments)
+    elif _is_json(url):
+        return _json_tiddlers(url, context)
+    else:  # we have a tiddler of some form
+        return [url_to_tiddler(url, context=context)]
+
+
+def _local_wiki_path(url):
+    """
+    Return the filepath of url if it is an uncompressed local file,
+    which can be indexed, or None.
+    """
+    if url.endswith('.gz') or _archive_member(url):
+        return None
+    return _url_to_path(url)
+
+
+def _index_store_area(content):
+    """
+    Find the byte offsets of each tiddler div in the storeArea of
+    content, a TiddlyWiki 2.x file as bytes. Return None if there
+    is no storeArea which can be scanned, as in TiddlyWiki 5.
+    """
+    # latin-1 keeps one character per byte, so offsets are the same
+    content = content.decode('latin-1')
+    if TW5_STORE.search(content):
+        return None
+    divs = _store_area_divs(content)
+    if divs is None:
+        return None
+    tiddlers = {}
+    for start, end in divs:
+        match = TIDDLER_DIV.match(content, start)
+        if match:
+            title = match.group(1).encode('latin-1').decode('utf-8',
+                    'replace')
+            tiddlers[_html_decode(title)] = [start, end]
+    return tiddlers
+
+
+def _indexed_tiddlers(path, index, titles, context):
+    """
+    Read the tiddlers with the given titles from the wiki at path,
+    seeking straight to each div listed in index.
+    """
+    tiddlers = []
+    handle = open(path, 'rb')
+    try:
+        for title in titles:
+            if title not in index:
+                continue
+            start, end = index[title]
+            handle.seek(start)
+            content = handle.read(end - start).decode('utf-8', 'replace')
+            with context.span('parse', path, title=title):
+                tiddlers.append(_div_to_tiddler(content, context))
+    finally:
+        handle.close()
+    return tiddlers
+
+
+def _read_file(path):
+    """
+    Read the whole of the file at path, as bytes.
+    """
+    handle = open(path, 'rb')
+    try:
+        return handle.read()
+    finally:
+        handle.close()
+
+
+def _index_path(path, index_dir):
+    """
+    The file in index_dir which holds the index of the wiki at path,
+    named for the SHA-1 digest of the wiki's absolute path.
+    """
+    name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(index_dir, name + INDEX_EXTENSION)
+
+
+def _write_index(index_path, index):
+    """
+    Save a wiki index, replacing any old one. An index which cannot
+    be saved is only logged, as it can always be built again.
+    """
+    index_dir = os.path.dirname(index_path)
+    try:
+        try:
+            os.makedirs(index_dir)
+        except OSError:
+            if not os.path.isdir(index_dir):
+                raise
+        descriptor, temporary = tempfile.mkstemp(dir=index_dir,
+                suffix=INDEX_EXTENSION)
+        handle = os.fdopen(descriptor, 'w')
+        try:
+            json.dump(index, handle)
+        finally:
+            handle.close()
+        os.rename(temporary, index_path)
+    except (IOError, OSError) as exc:
+        LOGGER.debug('unable to save wiki index %s: %s', index_path, exc)
+
+
+def _cached_size(result):
+    """
+    Roughly how much memory a cached result takes up, counting only
+    its bytes.
+    """
+    if isinstance(result, bytes):
+        return len(result)
+    if isinstance(result, tuple):
+        return sum(len(part) for part in result if isinstance(part, bytes))
+    return 0
+
+
+def _tiddler_size(tiddler):
+    """
+    Roughly how much memory a tiddler's content takes up.
+    """
+    return len(tiddler.title) + len(tiddler.text or '')
+
+
+def _store_tiddlers(bag_name, tiddlers, fragments, store):
+    """
+    Put tiddlers into the named bag, skipping those not listed in
+    fragments, if there are any fragments. Return how many were put.
+    """
+    count = 0
+    for tiddler in tiddlers:
+        if fragments and tiddler.title not in fragments:
+            continue
+        tiddler.bag = bag_name
+        store.put(tiddler)
+        count += 1
+    return count
+
+
+def _get_url(url, context=None):
     """
     Load a URL and decode it to unicode.
     """
-    content = urlopen(url).read().decode('utf-8', 'replace')
-    return content.replace('\r', '')
+    context = _get_context(context)
+    with context.span('meta probe', url):
+        content = context.cached(url,
+                lambda: _open_url(url, context).read())
+    return content.decode('utf-8', 'replace').replace('\r', '')
+
+
+def _read_url_handle(url, context=None):
+    """
+    Open url with get_url_handle and read all of it, returning
+    the final url and the content.
+    """
+    url, handle = get_url_handle(url, context=context)
+    return url, handle.read()
+
+
+def _open_url(url, context=None):
+    """
+    Open url, through the context's FetchScheduler if it is remote.
+    Remote responses are requested compressed and decompressed as
+    they are read. Archive members are read from their archive.
+    """
+    member = _archive_member(url)
+    if member:
+        archive_url, name = member
+        return _get_context(context).archive(archive_url).open(name)
+    if urlparse(url)[0] in ('http', 'https'):
+        if context is not None:
+            return context.scheduler.open(url)
+        return _decoded(urlopen(_request(url)))
+    return urlopen(url)
+
+
+def _request(url, method=None):
+    """
+    Make a Request for url which accepts compressed responses,
+    using method if it is not GET.
+    """
+    request = Request(url, headers={'Accept-Encoding': ACCEPT_ENCODING})
+    if method:
+        request.get_method = lambda: method
+    return request
 
 
-def _from_text(title, content):
+def _decoded(handle):
+    """
+    Wrap handle to decompress it if it has a Content-Encoding
+    we asked for.
+    """
+    encoding = (handle.headers.get('content-encoding') or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return _DecodedHandle(handle, 'gzip')
+    if encoding == 'deflate':
+        return _DecodedHandle(handle, 'deflate')
+    return handle
+
+
+def _uncompressed_url(url):
+    """
+    Remove a trailing .gz from url, leaving any type that follows
+    it in place.
+    """
+    target, space, mime_type = url.partition(' ')
+    if target.endswith('.gz'):
+        return target[:-3] + space + mime_type
+    return url
+
+
+def _is_recipe(url):
+    """
+    Is url a (possibly compressed) recipe?
+    """
+    return _uncompressed_url(url).endswith('.recipe')
+
+
+def _is_archive(url):
+    """
+    Is url a zip or tar archive (rather than a member of one)?
+    """
+    url = url.split(' ', 1)[0]
+    return (ARCHIVE_SEPARATOR not in url and
+            any(url.endswith(extension) for extension in ARCHIVE_EXTENSIONS))
+
+
+def _archive_url(url):
+    """
+    Make the url of an archive absolute, so that the URLs of its
+    members are too.
+    """
+    if not urlparse(url)[0]:
+        url = 'file://' + quote(os.path.abspath(url))
+    return url
+
+
+def _archive_member(url):
+    """
+    If url names a member of an archive, return the url of the
+    archive and the path of the member in it. Otherwise None.
+    """
+    if ARCHIVE_SEPARATOR not in url:
+        return None
+    archive_url, name = url.split(ARCHIVE_SEPARATOR, 1)
+    if not _is_archive(archive_url):
+        return None
+    return _archive_url(archive_url), unquote(name)
+
+
+def _is_json(url):
+    """
+    Is url a (possibly compressed) JSON list of tiddlers?
+    """
+    return _uncompressed_url(url).endswith('.json')
+
+
+def _is_wiki(url):
+    """
+    Is url a (possibly compressed) TiddlyWiki?
+    """
+    url = _uncompressed_url(url)
+    return url.endswith('.wiki') or url.endswith('.html')
+
+
+def _retry_after(headers):
+    """
+    Return the number of seconds a Retry-After header asks us to
+    wait, or None if there is no usable header.
+    """
+    value = headers and headers.get('retry-after')
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        delay = float(value)
+    except ValueError:
+        date = parsedate_tz(value)
+        if not date:
+            return None
+        delay = mktime_tz(date) - time.time()
+    return min(max(delay, 0), FETCH_MAX_DELAY)
+
+
+def _twimport(options, args, store, context):
+    """
+    Run the twimport command with its options and arguments.
+    """
+    processes = int(options.get('processes', IMPORT_PROCESSES))
+    if 'watch' in options and ('manifest' in options or 'plan' in options):
+        raise ValueError('--watch cannot be used with --manifest or --plan')
+    if 'manifest' in options:
+        manifest = manifest_to_list(options['manifest'], context=context)
+    else:
+        bag = args[0]
+        urls = args[1:]
+        if not bag or not urls:
+            raise IndexError('missing args')
+        manifest = [(bag, urls)]
+    if 'plan' in options:
+        print(plan_manifest(manifest, store, context=context).report())
+        return
+    max_items = int(options.get('buffer-items', BUFFER_ITEMS))
+    max_bytes = int(options.get('buffer-bytes', BUFFER_BYTES))
+    trace = options.get('trace')
+    profile = options.get('profile')
+    if 'manifest' in options:
+        report = import_manifest(manifest, store, processes=processes,
+                context=context, progress=_print_progress,
+                max_items=max_items, max_bytes=max_bytes,
+                trace=trace, profile=profile)
+        print(report.summary())
+        return
+    import_list(bag, urls, store, processes=processes, context=context,
+            max_items=max_items, max_bytes=max_bytes,
+            trace=trace, profile=profile)
+    if 'watch' in options:
+        interval = options['watch']
+        if interval is True:
+            interval = WATCH_INTERVAL
+        watcher = ImportWatcher(bag, urls, store, context=context)
+        for path in watcher.watch(float(interval)):
+            print('reimported from %s' % path)
+
+
+def _scheduler_from_options(options):
+    """
+    Make a FetchScheduler from twimport command options.
+    """
+    rate = options.get('rate')
+    burst = options.get('burst')
+    return FetchScheduler(
+            host_limit=int(options.get('host-limit', FETCH_HOST_LIMIT)),
+            rate=rate and float(rate),
+            burst=burst and int(burst),
+            retries=int(options.get('retries', FETCH_RETRIES)),
+            timeout=float(options.get('timeout', FETCH_TIMEOUT)))
+
+
+def _from_text(title, content, context=None):
     """
     Generates a tiddler from an RFC822-style string
 
     This corresponds to TiddlyWeb's text serialization of TiddlerS.
     """
-    tiddler = Tiddler(title)
-    serializer = Serializer('text')
-    serializer.object = tiddler
-    serializer.from_string(content)
-    return tiddler
+    return _get_context(context).from_text(title, content)
+
+
+def _get_context(context):
+    """
+    Return the provided ImportContext or, if there is not one,
+    a new context to be used for the rest of the current call.
+    """
+    if context is None:
+        context = ImportContext()
+    return context
 
 
 def _get_text(nodelist):
@@ -395,26 +2594,142 @@ def _get_tiddler_from_div(node):
     return tiddler
 
 
-def get_url_handle(url):
+def _get_tiddler_from_json(data):
+    """
+    Create a Tiddler from a dict of TiddlyWiki 5 tiddler fields.
+    Binary tiddlers, such as images, have their base64 text decoded.
+    """
+    tiddler = Tiddler(data['title'])
+    tiddler.text = data.get('text', '')
+    tags = data.get('tags', [])
+    if isinstance(tags, list):
+        tiddler.tags = tags
+    else:
+        tiddler.tags = string_to_tags_list(tags)
+
+    for field, value in data.items():
+        if field in TW5_IGNORED_FIELDS:
+            continue
+        if not isinstance(value, type(u'')):
+            value = json.dumps(value)
+        if field in ['created', 'modified']:
+            # TiddlyWiki 5 adds milliseconds to the 12 or 14 digits
+            tiddler.__setattr__(field, value[:14])
+        elif field in ['creator', 'modifier', 'type']:
+            tiddler.__setattr__(field, value)
+        else:
+            tiddler.fields[field] = value
+    if not data.get('modified') and tiddler.created:
+        tiddler.modified = tiddler.created
+    if _tw5_base64(tiddler.type):
+        try:
+            tiddler.text = base64.b64decode(tiddler.text.encode('ascii'))
+        except (binascii.Error, TypeError, UnicodeEncodeError):
+            tiddler.text = tiddler.text.encode('utf-8')
+    return tiddler
+
+
+def _tw5_base64(content_type):
+    """
+    Does TiddlyWiki 5 keep tiddlers of content_type as base64 text?
+    """
+    if not content_type:
+        return False
+    content_type = content_type.lower()
+    if content_type in TW5_TEXT_IMAGES:
+        return False
+    return (content_type.startswith(TW5_BASE64_PREFIXES)
+            or content_type in TW5_BASE64_TYPES)
+
+
+def get_url_handle(url, context=None):
     """
     Open the url using urllib2.urlopen. If the url is a filepath
-    transform it into a file url.
+    transform it into a file url. If there is a context, remote
+    urls are opened with its FetchScheduler.
+
+    If the url ends in .gz the content is decompressed as it is read
+    and the url returned is without the .gz, so that the rest of the
+    import treats it by its inner extension.
+
+    A url naming a file in an archive, as "<archive>!/<path>", is
+    made absolute and opened from the archive.
+
+    If there is a context the whole response is read before it is
+    returned, so that its span covers the transfer of the body and
+    the host's slot is given back straight away.
+
+    The bytes read are reserved with the context first. If there is
+    no room the response is closed, giving back the host's slot while
+    waiting, and requested again once there is.
+    """
+    if context is None:
+        return _get_url_handle(url, context)
+    with context.span('fetch', url):
+        first_url = url
+        reserved = 0
+        while True:
+            url, response = _get_url_handle(first_url, context)
+            if isinstance(response, _MemberHandle):
+                context.take(len(response.getvalue()) - reserved)
+                return url, response
+            length = _content_length(response)
+            if length <= reserved or context.reserve(length - reserved,
+                    wait=False):
+                break
+            response.close()
+            context.reserve(length - reserved)
+            reserved = length
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        context.take(len(data) - max(length, reserved))
+        return url, _MemberHandle(data, response.geturl(), response.headers)
+
+
+def _content_length(response):
+    """
+    The length a response says its body has, or 0 if it doesn't.
+    """
+    try:
+        return int(response.headers.get('content-length') or 0)
+    except (AttributeError, ValueError):
+        return 0
+
+
+def _get_url_handle(url, context):
+    """
+    Do the work of get_url_handle.
     """
+    member = _archive_member(url)
+    if member:
+        url = '%s%s%s' % (member[0], ARCHIVE_SEPARATOR, quote(member[1]))
     try:
         try:
             try:
-                handle = urlopen(url)
+                handle = _open_url(url, context)
+            except HTTPError:
+                raise
             except (URLError, OSError):
+                # The scheduler has already retried; only try again
+                # if quoting the path gives a different url.
                 (scheme, netloc, path, params, query,
                         fragment) = urlparse(url)
                 path = quote(path)
                 newurl = urlunparse((scheme, netloc, path,
                     params, query, fragment))
-                handle = urlopen(newurl)
+                if newurl == url:
+                    raise
+                handle = _open_url(newurl, context)
         except ValueError:
             # If ValueError happens again we want it to raise
             url = 'file://' + os.path.abspath(url)
             handle = urlopen(url)
+        if url.endswith('.gz'):
+            if not isinstance(handle, _DecodedHandle):
+                handle = _DecodedHandle(handle, 'gzip')
+            url = url[:-3]
         return url, handle
     except HTTPError as exc:
         raise ValueError('%s: %s' % (exc, url))
@@ -428,6 +2743,55 @@ def _html_decode(text):
             '&amp;', '&').replace('&quot;', '"')
 
 
+def _print_progress(line):
+    """
+    Report progress of the twimport command.
+    """
+    print(line)
+
+
+def _split_options(args):
+    """
+    Separate leading "--name" and "--name=value" options from the
+    remaining arguments to a command.
+    """
+    options = {}
+    args = list(args)
+    while args and args[0].startswith('--'):
+        option = args.pop(0)[2:]
+        if '=' in option:
+            name, value = option.split('=', 1)
+        else:
+            name, value = option, True
+        options[name] = value
+    return options, args
+
+
+def _url_to_path(url):
+    """
+    Turn a file URL or a filepath into an absolute filepath. Return
+    None for any other kind of URL.
+    """
+    scheme, _, path = urlparse(url)[:3]
+    if scheme == 'file':
+        return url2pathname(unquote(path))
+    if not scheme:
+        return os.path.abspath(url)
+    return None
+
+
+def _stat_path(path):
+    """
+    Summarize the state of a file so changes can be noticed.
+    A missing file is None.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
 def _parse_fragment(fragment):
     """
     Turn a TiddlyWiki permaview into a list of tiddlers.